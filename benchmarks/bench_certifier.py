@@ -0,0 +1,190 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+Benchmarks of certifier.actions and the lambda handlers against synthetic accounts mocked with moto.
+For each scenario and account size, the wall time, the peak memory allocated by Python and the number of calls
+to each AWS API operation are reported. API calls are compared with benchmarks/baseline.json,
+so that changes increasing the number of calls a scenario makes fail the run.
+
+Run with:
+    python -m pytest -s benchmarks/bench_certifier.py
+The account sizes are set by CERTIFIER_BENCH_SIZES (default "100"), like CERTIFIER_BENCH_SIZES=100,1000.
+The baseline covers sizes 100 and 1000, scenarios without a baseline are skipped.
+Set CERTIFIER_BENCH_UPDATE_BASELINE=1 to record the current number of calls as the baseline.
+"""
+
+import collections
+import functools
+import json
+import os
+import pathlib
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict
+import boto3  # type: ignore
+import cryptography.hazmat.primitives.asymmetric.rsa
+import moto  # type: ignore
+import pytest  # type: ignore
+from moto import mock_acm, mock_s3, mock_ssm  # type: ignore
+from certifier import certifier, throttling
+import handlers
+
+SIZES = [int(size) for size in os.environ.get("CERTIFIER_BENCH_SIZES", "100").split(",")]
+BASELINE_PATH = pathlib.Path(__file__).parent.joinpath("baseline.json")
+UPDATE_BASELINE = os.environ.get("CERTIFIER_BENCH_UPDATE_BASELINE") == "1"
+# Calls allowed above the baseline for each operation before failing, relative to the baseline and absolute
+TOLERANCE = 0.1
+SLACK = 2
+BUCKET = "certificates"
+
+
+class CallCounter:
+    """
+    Counts calls to each API operation made by the clients it is installed on, retries excluded
+    """
+
+    def __init__(self):
+        self.calls: Dict[str, int] = collections.Counter()
+        self._lock = threading.Lock()
+
+    def install(self, client):
+        client.meta.events.register("before-call", self._count)
+        return client
+
+    def _count(self, model, **kwargs):
+        with self._lock:
+            self.calls[model.name] += 1
+
+
+@pytest.fixture(scope="function", params=SIZES, ids=lambda size: f"{size}-certificates")
+def account(request, monkeypatch):
+    """
+    Mocked account with 'size' certificates managed by certifier, a third of them in each state,
+    in groups of three sharing an identifier, and a domains file for each identifier in BUCKET
+    """
+    # Generating a key for every certificate would make creating large accounts take hours
+    generate_private_key = functools.lru_cache(maxsize=None)(
+        cryptography.hazmat.primitives.asymmetric.rsa.generate_private_key
+    )
+    monkeypatch.setattr(cryptography.hazmat.primitives.asymmetric.rsa, "generate_private_key", generate_private_key)
+    mocks = [mock_acm(), mock_ssm(), mock_s3()]
+    for mock in mocks:
+        mock.start()
+
+    acm_client = boto3.client("acm")
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(Bucket=BUCKET)
+    states = (certifier.States.AVAILABLE, certifier.States.PENDING, certifier.States.MARKED_FOR_DELETION)
+    for number in range(request.param):
+        identifier = f"bench/{number // 3}"
+        certificate_arn = acm_client.request_certificate(DomainName=f"{number}.example.com", ValidationMethod="DNS")[
+            "CertificateArn"
+        ]
+        acm_client.add_tags_to_certificate(
+            CertificateArn=certificate_arn,
+            Tags=[
+                {"Key": certifier.Tags.IDENTIFIER.value, "Value": identifier},
+                {"Key": certifier.Tags.STATE.value, "Value": states[number % 3].value},
+            ],
+        )
+        if number % 3 == 0:
+            s3_client.put_object(Bucket=BUCKET, Key=f"{identifier}.txt", Body=f"{number}.example.com\n".encode())
+
+    # Benchmarks measure the work done, not how long it takes to stay within AWS rate limits
+    actions = certifier.actions(rate_limits={operation: 0 for operation in throttling.DEFAULT_RATE_LIMITS})
+    counter = CallCounter()
+    counter.install(actions.acm_client)
+    counter.install(actions.ssm_client)
+    monkeypatch.setattr(handlers, "actions", actions)
+    monkeypatch.setattr(handlers, "s3_client", counter.install(boto3.client("s3")))
+    yield request.param, actions, counter
+
+    for mock in mocks:
+        mock.stop()
+
+
+def s3_event(keys) -> Dict:
+    return {
+        "Records": [
+            {
+                "eventName": "ObjectCreated:Put",
+                "s3": {"bucket": {"name": BUCKET}, "object": {"key": key, "sequencer": f"{position:018X}"}},
+            }
+            for position, key in enumerate(keys)
+        ]
+    }
+
+
+def acm_event(certificate_arn) -> Dict:
+    return {"source": "aws.acm", "detail-type": "ACM Certificate Available", "resources": [certificate_arn]}
+
+
+SCENARIOS: Dict[str, Callable] = {
+    "query": lambda actions: actions.query(),
+    "query_pending_with_acm_state": lambda actions: actions.query(state=certifier.States.PENDING, with_acm_state=True),
+    "request_certificate": lambda actions: actions.request_certificate("bench/0", ["0.example.com"]),
+    "transition_to_available": lambda actions: (
+        actions.transition_to_available(actions.query(state=certifier.States.PENDING)),
+        actions.flush(),
+    ),
+    "delete": lambda actions: actions.delete(actions.query(state=certifier.States.MARKED_FOR_DELETION)),
+    "handlers.manage_certificates": lambda actions: handlers.manage_certificates(
+        s3_event(f"bench/{number}.txt" for number in range(10)), None
+    ),
+    "handlers.transition_certificates": lambda actions: handlers.transition_certificates({}, None),
+    "handlers.transition_certificate_events": lambda actions: handlers.transition_certificate_events(
+        acm_event(actions.query(state=certifier.States.PENDING)[0].arn), None
+    ),
+    "handlers.delete_certificates": lambda actions: handlers.delete_certificates({}, None),
+}
+
+
+@pytest.mark.parametrize("scenario", SCENARIOS)
+def test_scenario(scenario, account, monkeypatch):
+    size, actions, counter = account
+    # Pending certificates are issued right away, so transitions have work to do
+    monkeypatch.setattr(moto.settings, "ACM_VALIDATION_WAIT", 0)
+    if scenario == "handlers.transition_certificate_events":
+        actions.query()  # Look the event's certificate up beforehand, the handler discards the inventory
+
+    counter.calls.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    SCENARIOS[scenario](actions)
+    wall_time = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    calls = dict(sorted(counter.calls.items()))
+    print(
+        f"\n{scenario} with {size} certificates: {wall_time:.2f}s, peak memory {peak_memory / 1024 ** 2:.1f}MiB, "
+        f"{sum(calls.values())} API calls {calls}"
+    )
+
+    key = f"{scenario}[{size}]"
+    baseline = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    if UPDATE_BASELINE:
+        baseline[key] = calls
+        BASELINE_PATH.write_text(json.dumps(dict(sorted(baseline.items())), indent=2) + "\n")
+        return
+    if key not in baseline:
+        pytest.skip(f"No baseline for {key}, run with CERTIFIER_BENCH_UPDATE_BASELINE=1 to record it")
+    for operation, count in calls.items():
+        allowed = int(baseline[key].get(operation, 0) * (1 + TOLERANCE)) + SLACK
+        assert count <= allowed, f"{operation} was called {count} times, the baseline allows {allowed}"
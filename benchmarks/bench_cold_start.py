@@ -0,0 +1,115 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+Cold start benchmarks of the lambda handlers: each handler is imported and invoked once in a new interpreter,
+against empty accounts mocked with moto, reporting how long the import and the first invocation took
+and which AWS clients were created. Importing must not create any client, handlers must only create the clients
+they use, and the import must take less than CERTIFIER_IMPORT_BUDGET milliseconds (default 1000).
+
+Run with:
+    python -m pytest -s benchmarks/bench_cold_start.py
+"""
+
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import pytest  # type: ignore
+
+IMPORT_BUDGET = float(os.environ.get("CERTIFIER_IMPORT_BUDGET", 1000))
+ROOT = pathlib.Path(__file__).parent.parent
+
+# Handlers are imported before moto, which imports boto3 itself, clients being created on first use
+COLD_START = """
+import json, sys, time
+
+started = time.perf_counter()
+import handlers
+imported = time.perf_counter()
+
+import boto3
+from moto import mock_acm, mock_dynamodb, mock_route53, mock_s3, mock_ssm
+from certifier.state import DynamoDBStateStore
+
+for mock in (mock_acm(), mock_dynamodb(), mock_route53(), mock_s3(), mock_ssm()):
+    mock.start()
+
+# Resources named in the environment are created with separate clients, so they are not counted as created by handlers
+if handlers.CERTIFICATES_BUCKET:
+    boto3.client("s3").create_bucket(Bucket=handlers.CERTIFICATES_BUCKET)
+if handlers.ACTIONS_OPTIONS["state_table"]:
+    DynamoDBStateStore(boto3.client("dynamodb"), handlers.ACTIONS_OPTIONS["state_table"]).create_table()
+
+invoking = time.perf_counter()
+clients_after_import = sorted(handlers.actions._clients) + (["s3"] if handlers.s3_client else [])
+getattr(handlers, sys.argv[1])(json.loads(sys.argv[2]), None)
+invoked = time.perf_counter()
+print(json.dumps({
+    "import": (imported - started) * 1000,
+    "first_invocation": (invoked - invoking) * 1000,
+    "clients_after_import": clients_after_import,
+    "clients": sorted(handlers.actions._clients) + (["s3"] if handlers.s3_client else []),
+}))
+"""
+
+# Event, clients the handler is expected to create and environment of each handler
+HANDLERS = {
+    "manage_certificates": ({"Records": []}, [], {}),
+    "delete_certificates": ({}, ["acm", "ssm"], {}),
+    "transition_certificates": ({}, ["acm", "ssm"], {}),
+    "transition_certificate_events": ({"resources": []}, [], {}),
+    "reconcile_certificates": ({"dry_run": True}, ["acm", "s3"], {"CERTIFIER_BUCKET": "certifier-bench"}),
+    "export_validation_records": ({}, ["acm", "route53"], {}),
+    "scan_certificates": ({}, ["acm"], {}),
+    "rebuild_state_store": ({}, ["acm", "dynamodb"], {"CERTIFIER_STATE_TABLE": "certifier-bench-state"}),
+}
+
+
+def test_all_handlers_benchmarked():
+    import handlers
+
+    # Handlers are the functions decorated with handlers.invocation, which keeps the handler in __wrapped__
+    public_handlers = {
+        name
+        for name, function in vars(handlers).items()
+        if callable(function) and hasattr(function, "__wrapped__") and not name.startswith("_")
+    }
+    assert public_handlers == set(HANDLERS)
+
+
+@pytest.mark.parametrize("handler", HANDLERS)
+def test_cold_start(handler):
+    event, expected_clients, handler_environment = HANDLERS[handler]
+    environment = {"AWS_DEFAULT_REGION": "us-east-1", **os.environ, **handler_environment}
+    output = subprocess.run(
+        [sys.executable, "-c", COLD_START, handler, json.dumps(event)],
+        cwd=ROOT,
+        env=environment,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    result = json.loads(output.strip().split("\n")[-1])
+    print(
+        f"\n{handler}: import {result['import']:.0f}ms, first invocation {result['first_invocation']:.0f}ms, "
+        f"clients {result['clients']}"
+    )
+    assert result["clients_after_import"] == []
+    assert result["clients"] == expected_clients
+    assert result["import"] < IMPORT_BUDGET
@@ -15,4 +15,11 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
-from .certifier import Tags, States, Certificate, actions
+from .certifier import Tags, States, Certificate, DeletionSummary, HealthReport, Inventory, actions
+from .cache import TTLCache
+from .throttling import RateLimiter
+from .clients import create_client
+from .metrics import Metrics
+from .validation import ValidationRecordExporter
+from .state import DynamoDBStateStore
+from .leases import DynamoDBLeases, LeaseUnavailable
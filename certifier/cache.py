@@ -0,0 +1,70 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Tuple
+
+# Returned by TTLCache.get() for keys that are not cached, since None is a valid cached value
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe cache in which entries expire 'ttl' seconds after being set.
+    At most 'max_size' entries are kept, the least recently used entry is evicted when the cache is full.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 4096):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Any:
+        """
+        Returns the value cached for the key, or MISSING if it is not cached or has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -15,12 +15,23 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
-import string
-import random
-from dataclasses import dataclass
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timezone
 from enum import Enum
-from typing import List, Tuple, Dict, Generator, Iterable, Optional
-import boto3  # type: ignore
+from typing import List, Tuple, Dict, Generator, Iterable, Optional, Set
+from .cache import TTLCache, MISSING
+from .clients import CLIENT_CONFIG, create_client, get_session
+from .throttling import RateLimiter
+from .parameters import ParameterStore
+from .metrics import Metrics
+from .validation import dedupe_records
+from .state import DynamoDBStateStore
+from .leases import DynamoDBLeases
 
 
 class Tags(Enum):
@@ -30,6 +41,14 @@ class Tags(Enum):
 
     IDENTIFIER: str = "certifier_id"
     STATE: str = "certifier_state"
+    DELETE_ATTEMPTS: str = "certifier_delete_attempts"
+    DELETE_AFTER: str = "certifier_delete_after"
+    DOMAINS_HASH: str = "certifier_domains_hash"
+    SOURCE_ETAG: str = "certifier_source_etag"
+    RETRY_ATTEMPTS: str = "certifier_retry_attempts"
+    RETRY_AFTER: str = "certifier_retry_after"
+    REPLACES: str = "certifier_replaces"
+    SHARDS: str = "certifier_shards"
 
 
 class States(Enum):
@@ -40,6 +59,7 @@ class States(Enum):
     MARKED_FOR_DELETION: str = "certifier_delete"
     PENDING: str = "certifier_pending"
     AVAILABLE: str = "certifier_available"
+    GAVE_UP: str = "certifier_gave_up"
     ANY: str = "_"
 
 
@@ -54,6 +74,145 @@ class Certificate:
     state: States
     records: Optional[List[Tuple[str, str]]] = None
     acm_state: Optional[str] = None
+    domains: Optional[List[str]] = None
+    not_after: Optional[datetime] = None
+    issued_at: Optional[datetime] = None
+    in_use_by: Optional[List[str]] = None
+    renewal_status: Optional[str] = None
+    # Certifier tags other than Tags.IDENTIFIER and Tags.STATE
+    metadata: Dict[Tags, str] = field(default_factory=dict)
+
+    def certifier_tags(self) -> Dict[Tags, str]:
+        """
+        Returns all certifier tags of the certificate, as they are in ACM
+        """
+        return {Tags.IDENTIFIER: self.identifier, Tags.STATE: self.state.value, **self.metadata}
+
+
+@dataclass
+class DeletionSummary:
+    """
+    Class to represent the outcome of deleting a list of certificates, with the ARNs of:
+    * deleted: certificates that were deleted.
+    * not_found: certificates that no longer existed.
+    * in_use: certificates that could not be deleted as they are in use, which were scheduled for another attempt.
+    * deferred: certificates that were not attempted, as an earlier attempt found them in use and they are not due yet.
+    * failed: certificates that could not be deleted for any other reason, mapped to the reason.
+    """
+
+    deleted: List[str] = field(default_factory=list)
+    not_found: List[str] = field(default_factory=list)
+    in_use: List[str] = field(default_factory=list)
+    deferred: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class HealthReport:
+    """
+    Class to represent the health of available certificates, with the ARNs of:
+    * expired: certificates past their NotAfter date.
+    * critical: certificates expiring in less than the critical number of days.
+    * expiring: certificates expiring in less than the warning number of days, but not critically.
+    * renewal_stuck: certificates whose managed renewal failed or is waiting for validation records.
+    * healthy: certificates in none of the above.
+    The days left before each certificate expires are mapped to its ARN in days_to_expiry.
+    """
+
+    expired: List[str] = field(default_factory=list)
+    critical: List[str] = field(default_factory=list)
+    expiring: List[str] = field(default_factory=list)
+    renewal_stuck: List[str] = field(default_factory=list)
+    healthy: List[str] = field(default_factory=list)
+    days_to_expiry: Dict[str, int] = field(default_factory=dict)
+
+    def at_risk(self) -> List[str]:
+        """
+        Returns the ARNs of the certificates that are expired or expiring critically,
+        or expiring while their managed renewal is stuck
+        """
+        return self.expired + self.critical + [arn for arn in self.expiring if arn in self.renewal_stuck]
+
+
+class Inventory:
+    """
+    In-memory index of the certificates managed by certifier, by ARN, by identifier and by state.
+    Lookups for any combination of identifier and state do not require scanning all certificates.
+    """
+
+    def __init__(self, certificates: Iterable[Certificate] = ()):
+        self._lock = threading.Lock()
+        self._by_arn: Dict[str, Certificate] = {}
+        self._by_identifier: Dict[str, Dict[str, Certificate]] = {}
+        self._by_state: Dict[States, Dict[str, Certificate]] = {}
+        self._by_identifier_and_state: Dict[Tuple[str, States], Dict[str, Certificate]] = {}
+        for certificate in certificates:
+            self.add(certificate)
+
+    def _indexes(self, certificate: Certificate) -> Tuple[Dict[str, Certificate], ...]:
+        """
+        Returns every index bucket the certificate belongs to, creating empty buckets as needed
+        """
+        return (
+            self._by_identifier.setdefault(certificate.identifier, {}),
+            self._by_state.setdefault(certificate.state, {}),
+            self._by_identifier_and_state.setdefault((certificate.identifier, certificate.state), {}),
+        )
+
+    def add(self, certificate: Certificate) -> None:
+        """
+        Adds a certificate to the inventory, replacing any certificate with the same ARN
+        """
+        with self._lock:
+            self._remove(certificate.arn)
+            self._by_arn[certificate.arn] = certificate
+            for index in self._indexes(certificate):
+                index[certificate.arn] = certificate
+
+    def _remove(self, arn: str) -> Optional[Certificate]:
+        certificate = self._by_arn.pop(arn, None)
+        if certificate is not None:
+            for index in self._indexes(certificate):
+                index.pop(arn, None)
+        return certificate
+
+    def remove(self, arn: str) -> Optional[Certificate]:
+        """
+        Removes the certificate with the given ARN from the inventory, returning it if it was present
+        """
+        with self._lock:
+            return self._remove(arn)
+
+    def set_state(self, arn: str, state: States) -> None:
+        """
+        Moves the certificate with the given ARN to a new state, ignoring unknown ARNs
+        """
+        with self._lock:
+            certificate = self._remove(arn)
+            if certificate is None:
+                return
+            certificate.state = state
+            self._by_arn[arn] = certificate
+            for index in self._indexes(certificate):
+                index[arn] = certificate
+
+    def get(self, arn: str) -> Optional[Certificate]:
+        return self._by_arn.get(arn)
+
+    def query(self, identifier: str = None, state: States = States.ANY) -> List[Certificate]:
+        """
+        Returns the certificates matching the identifier and state, either of which can be omitted
+        """
+        with self._lock:
+            if identifier is None and state == States.ANY:
+                index = self._by_arn
+            elif identifier is None:
+                index = self._by_state.get(state, {})
+            elif state == States.ANY:
+                index = self._by_identifier.get(identifier, {})
+            else:
+                index = self._by_identifier_and_state.get((identifier, state), {})
+            return list(index.values())
 
 
 class actions:
@@ -61,20 +220,220 @@ class actions:
     Actions represent operations that can be performed on a certificate or group of certificates
     """
 
-    def __init__(self):
-        self.acm_client = boto3.client("acm")
-        self.ssm_client = boto3.client("ssm")
+    def __init__(
+        self,
+        max_items: Optional[int] = None,
+        includes: Optional[Dict] = None,
+        cache_ttl: Optional[float] = None,
+        cache_size: int = 4096,
+        rate_limits: Optional[Dict[str, float]] = None,
+        delete_retry_delay: float = 3600,
+        max_delete_retry_delay: float = 7 * 24 * 3600,
+        retry_delay: float = 3600,
+        max_retry_delay: float = 24 * 3600,
+        max_retries: int = 8,
+        state_table: Optional[str] = None,
+        region: Optional[str] = None,
+        lease_table: Optional[str] = None,
+        lease_ttl: float = 300,
+    ):
+        """
+        'max_items' caps how many certificates are retrieved from ACM when listing certificates and
+        'includes' is passed as-is as the 'Includes' filter of list_certificates (e.g. {"keyTypes": ["RSA_2048"]}).
+        When 'cache_ttl' is set, certifier tags and describe_certificate results are cached for that many seconds,
+        for at most 'cache_size' certificates each, so they can be reused across invocations of a warm container.
+        Requests are paced by self.rate_limiter, 'rate_limits' overrides its requests per second per API operation.
+        API calls and the certificates requested, transitioned, deleted and failed are counted in self.metrics.
+        Certificates found in use when deleting them are attempted again after 'delete_retry_delay' seconds,
+        doubling the delay for every attempt up to 'max_delete_retry_delay' seconds.
+        Certificates that failed validation are requested again right away the first time, and then after
+        'retry_delay' seconds, doubling the delay for every retry up to 'max_retry_delay' seconds,
+        until they failed 'max_retries' times, see retry().
+        When 'state_table' is set, certifier tags are mirrored in that DynamoDB table by self.state_store,
+        which queries are answered from instead of listing all certificates in ACM.
+        Clients are created for 'region', or the region of the environment when it is not set.
+        When 'lease_table' is set, lease() takes leases in that DynamoDB table through self.leases,
+        which expire after 'lease_ttl' seconds if they are not released.
+        """
+        self.region = region
+        self.rate_limiter = RateLimiter(rate_limits)
+        self.metrics = Metrics()
+        # Clients are created on first use, see _client()
+        self._clients: Dict[str, object] = {}
+        self._clients_lock = threading.Lock()
+        self._parameters: Optional[ParameterStore] = None
+        self.state_table = state_table
+        self._state_store: Optional[DynamoDBStateStore] = None
+        self.lease_table = lease_table
+        self.lease_ttl = lease_ttl
+        self._leases: Optional[DynamoDBLeases] = None
+        # Certificates written to and removed from the state store since the last reset_inventory(),
+        # which take precedence over the eventually consistent indexes of the state store
+        self._written = Inventory()
+        self._removed: Set[str] = set()
+        self.max_items = max_items
+        self.delete_retry_delay = delete_retry_delay
+        self.max_delete_retry_delay = max_delete_retry_delay
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_retries = max_retries
+        self.includes = includes
+        # Tag lookups are I/O bound, so use as many workers as the client can keep connections open
+        self.max_workers: int = CLIENT_CONFIG.max_pool_connections
+        self.inventory: Optional[Inventory] = None
+        self._inventory_lock = threading.Lock()
+        self.tags_cache: Optional[TTLCache] = None
+        self.describe_cache: Optional[TTLCache] = None
+        if cache_ttl:
+            self.tags_cache = TTLCache(cache_ttl, cache_size)
+            self.describe_cache = TTLCache(cache_ttl, cache_size)
+
+    def _client(self, service: str):
+        """
+        Returns the client for the service, creating it from the shared session on first use
+        """
+        with self._clients_lock:
+            if service not in self._clients:
+                self._clients[service] = self.install(create_client(service, self.region))
+            return self._clients[service]
+
+    @property
+    def region_name(self) -> str:
+        """
+        Returns the region certificates are managed in
+        """
+        return self.region or get_session().region_name
+
+    @property
+    def acm_client(self):
+        return self._client("acm")
+
+    @acm_client.setter
+    def acm_client(self, client):
+        self._clients["acm"] = client
+
+    @property
+    def ssm_client(self):
+        return self._client("ssm")
+
+    @ssm_client.setter
+    def ssm_client(self, client):
+        self._clients["ssm"] = client
+
+    @property
+    def route53_client(self):
+        return self._client("route53")
+
+    @route53_client.setter
+    def route53_client(self, client):
+        self._clients["route53"] = client
+
+    @property
+    def dynamodb_client(self):
+        return self._client("dynamodb")
+
+    @dynamodb_client.setter
+    def dynamodb_client(self, client):
+        self._clients["dynamodb"] = client
+
+    @property
+    def state_store(self) -> Optional[DynamoDBStateStore]:
+        """
+        Returns the store certifier tags are mirrored in, or None when 'state_table' was not set.
+        Any object with the same methods as DynamoDBStateStore can be assigned to use another backend.
+        """
+        if self._state_store is None and self.state_table is not None:
+            self._state_store = DynamoDBStateStore(self.dynamodb_client, self.state_table, self.max_workers)
+        return self._state_store
+
+    @state_store.setter
+    def state_store(self, state_store):
+        self._state_store = state_store
+
+    @property
+    def leases(self) -> Optional[DynamoDBLeases]:
+        """
+        Returns the leases lease() takes, or None when 'lease_table' was not set.
+        Leases protect files rather than regional resources, so the table is always the one in the region
+        of the environment, whatever 'region' is, and actions of all regions share it.
+        """
+        if self._leases is None and self.lease_table is not None:
+            dynamodb_client = self.dynamodb_client if self.region is None else self.install(create_client("dynamodb"))
+            self._leases = DynamoDBLeases(dynamodb_client, self.lease_table, self.lease_ttl, self.max_workers)
+        return self._leases
+
+    @leases.setter
+    def leases(self, leases):
+        self._leases = leases
+
+    @contextmanager
+    def lease(self, names: Iterable[str], wait: float = 0) -> Generator[Set[str], None, None]:
+        """
+        Leases the names for the duration of the block, waiting up to 'wait' seconds for names leased by someone else,
+        and yields the names that were leased. Without 'lease_table' nothing is leased and all names are yielded.
+        Names are leased per region certificates are managed in, so actions of different regions
+        can work on the same names concurrently.
+        """
+        if self.leases is None:
+            yield set(names)
+            return
+        regional_names = {f"{self.region_name}:{name}": name for name in names}
+        with self.leases.hold(regional_names, wait) as leased:
+            yield {regional_names[name] for name in leased}
+
+    @property
+    def parameters(self) -> ParameterStore:
+        if self._parameters is None:
+            self._parameters = ParameterStore(self.ssm_client, self.max_workers)
+        return self._parameters
+
+    def install(self, client):
+        """
+        Installs the rate limiter and metrics collection on a boto client, returning the client
+        """
+        return self.metrics.install(self.rate_limiter.install(client))
+
+    def reset_inventory(self) -> None:
+        """
+        Discards the inventory, so the next query retrieves certificates from ACM again.
+        Should be called at the start of each invocation, as actions may outlive a single one.
+        """
+        self.inventory = None
+        self._written = Inventory()
+        self._removed = set()
+
+    def _get_inventory(self) -> Inventory:
+        """
+        Returns the inventory of certificates, scanning ACM to build it if it was not built yet
+        """
+        with self._inventory_lock:
+            if self.inventory is None:
+                self.inventory = Inventory(self._raw_certificates_to_objects(self._list_certificates()))
+            return self.inventory
 
     def _list_certificates(self) -> Generator[Dict, None, None]:
         """
-        Runs list_certificates() however many api calls are necessary to retrieve all existing ACM certificates
+        Runs list_certificates() however many api calls are necessary to retrieve all existing ACM certificates,
+        yielding certificates as each page is received
         """
-        while True:
-            list_certificates_response: Dict = self.acm_client.list_certificates()
-            for raw_certificate in list_certificates_response["CertificateSummaryList"]:
-                yield raw_certificate
-            if "NextToken" not in list_certificates_response:
-                break
+        paginate_args: Dict = {"PaginationConfig": {"MaxItems": self.max_items}}
+        if self.includes:
+            paginate_args["Includes"] = self.includes
+        for list_certificates_response in self.acm_client.get_paginator("list_certificates").paginate(**paginate_args):
+            yield from list_certificates_response["CertificateSummaryList"]
+
+    def _describe_certificate(self, certificate_arn: str) -> Dict:
+        """
+        Returns the "Certificate" part of the describe_certificate response, from the cache when possible
+        """
+        if self.describe_cache is not None:
+            certificate_data = self.describe_cache.get(certificate_arn)
+            if certificate_data is not MISSING:
+                return certificate_data
+        certificate_data = self.acm_client.describe_certificate(CertificateArn=certificate_arn)["Certificate"]
+        if self.describe_cache is not None:
+            self.describe_cache.set(certificate_arn, certificate_data)
+        return certificate_data
 
     def _get_acm_state(self, certificate: Certificate) -> str:
         """
@@ -82,7 +441,71 @@ class actions:
         FAILED, ISSUED or PENDING_VALIDATION
         We refer to at as acm_state to be complient with the cetifier "state" naming.
         """
-        return self.acm_client.describe_certificate(CertificateArn=certificate.arn)["Certificate"]["Status"]
+        return self._describe_certificate(certificate.arn)["Status"]
+
+    def describe(self, certificates: Iterable[Certificate]) -> None:
+        """
+        Describes each certificate in ACM exactly once and fills in the records, acm_state, domains,
+        not_after, issued_at, in_use_by and renewal_status attributes of the certificate objects
+        from the same response.
+        Certificates are described concurrently, with at most self.max_workers requests in flight.
+        """
+
+        def describe_certificate(certificate: Certificate) -> None:
+            certificate_data = self._describe_certificate(certificate.arn)
+            certificate.records = self._records_from_description(certificate_data)
+            certificate.acm_state = certificate_data["Status"]
+            certificate.domains = self._domains_from_description(certificate_data)
+            certificate.not_after = certificate_data.get("NotAfter")
+            certificate.issued_at = certificate_data.get("IssuedAt")
+            certificate.in_use_by = certificate_data.get("InUseBy", [])
+            certificate.renewal_status = certificate_data.get("RenewalSummary", {}).get("RenewalStatus")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Consume the results so exceptions raised while describing are propagated
+            list(executor.map(describe_certificate, certificates))
+
+    def _get_certifier_tags(self, certificate_arn: str) -> Optional[Dict[Tags, str]]:
+        """
+        Returns the certifier tags of a certificate, or None if the certificate does not contain
+        both the certifier Tags.IDENTIFIER and Tags.STATE tags
+        """
+        if self.tags_cache is not None:
+            certifier_tags = self.tags_cache.get(certificate_arn)
+            if certifier_tags is not MISSING:
+                return certifier_tags
+
+        raw_tags = self.acm_client.list_tags_for_certificate(CertificateArn=certificate_arn)["Tags"]
+        tags: Dict[Tags, str] = {}
+        for tag in raw_tags:
+            try:
+                tags.update({Tags(tag["Key"]): tag["Value"]})
+            except ValueError:
+                print(f"Ignoring unknown tag {tag['Key']}")
+
+        certifier_tags = tags if Tags.IDENTIFIER in tags and Tags.STATE in tags else None
+        if self.tags_cache is not None:
+            self.tags_cache.set(certificate_arn, certifier_tags)
+        return certifier_tags
+
+    @staticmethod
+    def _certificate_from_tags(certificate_arn: str, certifier_tags: Dict[Tags, str]) -> Certificate:
+        return Certificate(
+            certifier_tags[Tags.IDENTIFIER],
+            certificate_arn,
+            States(certifier_tags[Tags.STATE]),
+            metadata={tag: value for tag, value in certifier_tags.items() if tag not in (Tags.IDENTIFIER, Tags.STATE)},
+        )
+
+    def _raw_certificate_to_object(self, raw_certificate: Dict) -> Optional[Certificate]:
+        """
+        Converts a raw certificate as returned by a list_certificates API call to a certifier.Certificate object,
+        returning None if the certificate does not contain both the certifier Tags.IDENTIFIER and Tags.STATE tags
+        """
+        certifier_tags = self._get_certifier_tags(raw_certificate["CertificateArn"])
+        if certifier_tags is None:
+            return None
+        return self._certificate_from_tags(raw_certificate["CertificateArn"], certifier_tags)
 
     def _raw_certificates_to_objects(
         self,
@@ -91,123 +514,395 @@ class actions:
         """
         Converts a list of raw certificates as returned by a list_certitificates API call
         to a list of certifier.Certificate objects, ignoring certificates that do not contain both the
-        certifier Tags.IDENTIFIER and Tags.STATE tags
+        certifier Tags.IDENTIFIER and Tags.STATE tags.
+        Tags are retrieved concurrently, with at most self.max_workers requests in flight.
         """
-        certificates: List[Certificate] = []
-        for raw_certificate in raw_certificates:
-            raw_tags = self.acm_client.list_tags_for_certificate(CertificateArn=raw_certificate["CertificateArn"])[
-                "Tags"
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return [
+                certificate
+                for certificate in executor.map(self._raw_certificate_to_object, raw_certificates)
+                if certificate is not None
             ]
-            tags: Dict[Tags, str] = {}
-            for tag in raw_tags:
-                try:
-                    tags.update({Tags(tag["Key"]): tag["Value"]})
-                except ValueError:
-                    print(f"Ignoring unknown tag {tag['Key']}")
-
-                if Tags.IDENTIFIER in tags and Tags.STATE in tags:
-                    certificate = Certificate(
-                        tags[Tags.IDENTIFIER],
-                        raw_certificate["CertificateArn"],
-                        States(tags[Tags.STATE]),
-                    )
-
-                    certificates.append(certificate)
-        return certificates
 
     def query(
         self, identifier: str = None, state: States = States.ANY, with_records=False, with_acm_state: bool = False
     ) -> List[Certificate]:
         """
-        Retrieves all ACM certificates and filters for the ones managed by certifier.
+        Retrieves all ACM certificates managed by certifier from the inventory, which is built on the first query,
+        or from the state store when there is one.
         More narrowed-down results can be obtained by filtering only for a specific
         identifier, specific state or both when 'identifier' and 'state' arguments are specified.
         """
-        all_certificates: List[Certificate] = self._raw_certificates_to_objects(self._list_certificates())
-
-        result_set: List[Certificate] = []
-        for certificate in all_certificates:
-            if identifier is None or identifier == certificate.identifier:
-                if state == States.ANY or state == certificate.state:
-                    result_set.append(certificate)
-                    if with_records:
-                        certificate.records = self._get_records(certificate.arn)
-                    if with_acm_state:
-                        certificate.acm_state = self._get_acm_state(certificate)
+        if self.state_store is not None:
+            result_set = self._query_state_store(identifier, state)
+        else:
+            result_set = self._get_inventory().query(identifier=identifier, state=state)
+        if with_records or with_acm_state:
+            self.describe(result_set)
         return result_set
 
-    def _get_records(self, certificate_arn) -> List[Tuple[str, str]]:
+    def scan(
+        self, state: States = States.ANY, after: Optional[str] = None
+    ) -> Generator[Tuple[List[Certificate], str], None, None]:
         """
-        Returns a list of tuples containing (domain_validation_name, domain_validation_value)
-        all of which are CNAMEs
+        Scans the certificates in a state in the order of their ARN, skipping the ARNs up to 'after',
+        yielding the certificates of each chunk of self.max_workers ARNs along with the last ARN of the chunk.
+        When the inventory was not built and there is no state store, the tags of a chunk are only retrieved
+        when the chunk is requested, so the caller can stop between chunks instead of waiting for the tags
+        of all certificates, and scan again after the last ARN it received later.
         """
-        certificate_data = self.acm_client.describe_certificate(CertificateArn=certificate_arn)["Certificate"]
-        domain_validation_options = certificate_data.get("DomainValidationOptions", [])
+        known: Optional[Dict[str, Certificate]] = None
+        if self.inventory is not None or self.state_store is not None:
+            known = {certificate.arn: certificate for certificate in self.query(state=state)}
+            arns = sorted(known)
+        else:
+            arns = sorted(raw_certificate["CertificateArn"] for raw_certificate in self._list_certificates())
+        arns = [arn for arn in arns if after is None or arn > after]
+        for start in range(0, len(arns), self.max_workers):
+            chunk = arns[start : start + self.max_workers]
+            if known is not None:
+                yield [known[arn] for arn in chunk], chunk[-1]
+                continue
+            certificates = self._raw_certificates_to_objects({"CertificateArn": arn} for arn in chunk)
+            yield [
+                certificate for certificate in certificates if state == States.ANY or certificate.state == state
+            ], chunk[-1]
+
+    def _query_state_store(self, identifier: Optional[str], state: States) -> List[Certificate]:
+        """
+        Retrieves certificates from the state store, replacing the ones written or removed by this object since
+        the last reset_inventory(), as they may not be reflected in the indexes of the state store yet
+        """
+        certificates: Dict[str, Certificate] = {
+            arn: self._certificate_from_tags(arn, {Tags(key): value for key, value in tags.items()})
+            for arn, tags in self.state_store.query(
+                identifier=identifier, state=None if state == States.ANY else state.value
+            ).items()
+        }
+        for certificate in self._written.query():
+            certificates.pop(certificate.arn, None)
+        for arn in self._removed:
+            certificates.pop(arn, None)
+        for certificate in self._written.query(identifier=identifier, state=state):
+            certificates[certificate.arn] = certificate
+        return list(certificates.values())
+
+    def _store(self, certificate: Certificate) -> None:
+        """
+        Writes a certificate to the state store, if there is one
+        """
+        if self.state_store is None:
+            return
+        self.state_store.put(
+            certificate.arn,
+            certificate.identifier,
+            certificate.state.value,
+            {tag.value: value for tag, value in certificate.certifier_tags().items()},
+        )
+        self._written.add(certificate)
+        self._removed.discard(certificate.arn)
 
+    def rebuild_state_store(self) -> List[str]:
+        """
+        Replaces the contents of the state store with the certifier tags of all certificates in ACM,
+        returning the ARNs of the certificates that were removed from it as they no longer exist
+        """
+        self.reset_inventory()
+        return self.state_store.rebuild(
+            {
+                certificate.arn: (
+                    certificate.identifier,
+                    certificate.state.value,
+                    {tag.value: value for tag, value in certificate.certifier_tags().items()},
+                )
+                for certificate in self._get_inventory().query()
+            }
+        )
+
+    @staticmethod
+    def _records_from_description(certificate_data: Dict) -> List[Tuple[str, str]]:
+        """
+        Returns a list of tuples containing (domain_validation_name, domain_validation_value),
+        all of which are CNAMEs, from the "Certificate" part of a describe_certificate response.
+        Domains for which ACM did not generate a record yet are skipped.
+        """
         return [
             (option["ResourceRecord"]["Name"], option["ResourceRecord"]["Value"])
-            for option in domain_validation_options
+            for option in certificate_data.get("DomainValidationOptions", [])
+            if "ResourceRecord" in option
         ]
 
+    @staticmethod
+    def _domains_from_description(certificate_data: Dict) -> List[str]:
+        """
+        Returns the DomainName followed by the SubjectAlternativeNames other than the DomainName
+        from the "Certificate" part of a describe_certificate response
+        """
+        domain_name = certificate_data["DomainName"]
+        return [domain_name] + [
+            domain for domain in certificate_data.get("SubjectAlternativeNames", []) if domain != domain_name
+        ]
+
+    def get_certificate(self, certificate_arn: str) -> Optional[Certificate]:
+        """
+        Returns the certificate with the given ARN, or None if it does not exist or is not managed by certifier.
+        Only the certificate's tags are retrieved when the inventory was not built, instead of scanning all certificates.
+        """
+        if self.inventory is not None:
+            return self.inventory.get(certificate_arn)
+        try:
+            certifier_tags = self._get_certifier_tags(certificate_arn)
+        except self.acm_client.exceptions.ResourceNotFoundException:
+            return None
+        if certifier_tags is None:
+            return None
+        return self._certificate_from_tags(certificate_arn, certifier_tags)
+
+    def _get_available_by_identifier(self, identifiers: List[str]) -> Dict[str, List[Certificate]]:
+        """
+        Returns the certificates in the States.AVAILABLE state of each identifier by identifier.
+        When the inventory was not built, the ARNs published in Parameter Store for the identifiers are used
+        instead of scanning all certificates, since they always refer to the latest available certificate.
+        They are read in batches, and the tags of the certificates they refer to are retrieved concurrently.
+        """
+        if self.inventory is not None or self.state_store is not None:
+            return {identifier: self.query(identifier=identifier, state=States.AVAILABLE) for identifier in identifiers}
+        certificate_arns = self.parameters.get(identifiers)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            certificates = dict(zip(certificate_arns, executor.map(self.get_certificate, certificate_arns.values())))
+        return {
+            identifier: [
+                certificate
+                for certificate in [certificates.get(identifier)]
+                if certificate is not None
+                and certificate.identifier == identifier
+                and certificate.state == States.AVAILABLE
+            ]
+            for identifier in identifiers
+        }
+
+    def _get_records(self, certificate_arn) -> List[Tuple[str, str]]:
+        """
+        Returns a list of tuples containing (domain_validation_name, domain_validation_value)
+        all of which are CNAMEs
+        """
+        return self._records_from_description(self._describe_certificate(certificate_arn))
+
+    def validation_records(self) -> List[Tuple[str, str]]:
+        """
+        Returns the unique (domain_validation_name, domain_validation_value) CNAMEs of all pending certificates,
+        certificates sharing domains sharing the same records
+        """
+        return dedupe_records(
+            record
+            for certificate in self.query(state=States.PENDING, with_records=True)
+            for record in certificate.records
+        )
+
     def mark_for_deletion(self, certificates: List[Certificate]) -> None:
         """
         Applies the certifier state States.MARKED_FOR_DELETION to a list of certificates
         by updating the tag Tags.STATE in ACM
         """
         for certificate in certificates:
-            self.acm_client.add_tags_to_certificate(
-                CertificateArn=certificate.arn,
-                Tags=({"Key": Tags.STATE.value, "Value": States.MARKED_FOR_DELETION.value},),
-            )
+            self._add_tags(certificate, {Tags.STATE: States.MARKED_FOR_DELETION.value})
+            self.metrics.increment("CertificatesMarkedForDeletion")
+
+    def _delete_ssm_parameters(self, certificates: List[Certificate]) -> None:
+        """
+        Deletes the SSM parameters of the certificates' identifiers, so long as they still contain a deleted certificate's ARN
+        """
+        expected_values: Dict[str, Set[str]] = {}
+        for certificate in certificates:
+            expected_values.setdefault(certificate.identifier, set()).add(certificate.arn)
+        self.parameters.delete_if_matches(expected_values)
+
+    def _add_tags(self, certificate: Certificate, tags: Dict[Tags, str]) -> None:
+        """
+        Adds certifier tags to a certificate in ACM, updating the certificate's metadata, the inventory and the cache
+        """
+        self.acm_client.add_tags_to_certificate(
+            CertificateArn=certificate.arn, Tags=[{"Key": tag.value, "Value": value} for tag, value in tags.items()]
+        )
+        metadata = {tag: value for tag, value in tags.items() if tag not in (Tags.IDENTIFIER, Tags.STATE)}
+        certificate.metadata.update(metadata)
+        if self.inventory is not None:
+            known_certificate = self.inventory.get(certificate.arn)
+            if known_certificate is not None:
+                known_certificate.metadata.update(metadata)
+            if Tags.STATE in tags:
+                self.inventory.set_state(certificate.arn, States(tags[Tags.STATE]))
+        if self.tags_cache is not None:
+            self.tags_cache.set(certificate.arn, {**certificate.certifier_tags(), **tags})
+        if Tags.STATE in tags:
+            certificate = replace(certificate, state=States(tags[Tags.STATE]), metadata=dict(certificate.metadata))
+        self._store(certificate)
+
+    def update_metadata(self, certificate: Certificate, metadata: Dict[Tags, str]) -> None:
+        """
+        Adds or updates certifier tags other than Tags.IDENTIFIER and Tags.STATE of a certificate,
+        like the tags of certificates requested before they were introduced
+        """
+        self._add_tags(certificate, metadata)
+
+    def _remember(self, certificate: Certificate) -> None:
+        """
+        Adds a certificate created in ACM to the inventory and the cache
+        """
+        if self.inventory is not None:
+            self.inventory.add(certificate)
+        if self.tags_cache is not None:
+            self.tags_cache.set(certificate.arn, certificate.certifier_tags())
+        self._store(certificate)
+
+    def _forget(self, certificate: Certificate) -> None:
+        """
+        Removes a certificate that no longer exists in ACM from the inventory and the cache
+        """
+        if self.inventory is not None:
+            self.inventory.remove(certificate.arn)
+        if self.tags_cache is not None:
+            self.tags_cache.pop(certificate.arn)
+        if self.describe_cache is not None:
+            self.describe_cache.pop(certificate.arn)
+        if self.state_store is not None:
+            self.state_store.delete(certificate.arn)
+            self._written.remove(certificate.arn)
+            self._removed.add(certificate.arn)
 
-    def _delete_ssm_parameter(self, certificate):
-        ssm_parameter_name = f"/certifier/{certificate.identifier}"
+    def _delete_certificate(self, certificate: Certificate) -> Tuple[str, str]:
+        """
+        Deletes a certificate in ACM, returning the outcome ("deleted", "not_found", "in_use" or "failed")
+        along with a description of it
+        """
         try:
-            ssm_parameter = self.ssm_client.get_parameter(Name=ssm_parameter_name)
-            if certificate.arn == ssm_parameter.get("Parameter", {}).get("Value", ""):
-                self.ssm_client.delete_parameter(Name=ssm_parameter_name)
-        except self.ssm_client.exceptions.ParameterNotFound:
-            print(f"No parameter found with name {ssm_parameter_name}")
+            self.acm_client.delete_certificate(CertificateArn=certificate.arn)
+            self._forget(certificate)
+            return "deleted", "Certificate deleted."
+        except self.acm_client.exceptions.ResourceNotFoundException:
+            self._forget(certificate)
+            return "not_found", "Certificate not found when attempting to delete."
+        except self.acm_client.exceptions.ResourceInUseException:
+            return "in_use", "Certificate in use."
+        except self.acm_client.exceptions.InvalidArnException:
+            return "failed", "Certificate has an invalid arn."
+        except Exception as e:
+            return "failed", f"Uknown exception: {e}"
 
-    def delete(self, certificates: List[Certificate]) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+    def _defer_deletion(self, certificate: Certificate) -> None:
         """
-        Delete a list of certificates in ACM, returning a tuple
-        with a list of successful deletions and a list of failed deletions.
+        Schedules another attempt to delete a certificate that is in use, backing off exponentially
+        with the number of attempts up to self.max_delete_retry_delay
+        """
+        attempts = int(certificate.metadata.get(Tags.DELETE_ATTEMPTS, 0)) + 1
+        delay = min(self.delete_retry_delay * 2 ** (attempts - 1), self.max_delete_retry_delay)
+        self._add_tags(
+            certificate,
+            {Tags.DELETE_ATTEMPTS: str(attempts), Tags.DELETE_AFTER: str(int(time.time() + delay))},
+        )
+
+    def delete(self, certificates: List[Certificate]) -> DeletionSummary:
         """
-        success: List[Dict[str, str]] = []
-        failed: List[Dict[str, str]] = []
+        Delete a list of certificates in ACM concurrently, returning a DeletionSummary.
+        Certificates found in use are tagged with the number of attempts and when to attempt again,
+        certificates that are not due for another attempt yet are skipped.
+        The SSM parameters of deleted certificates are removed in bulk afterwards.
+        """
+        summary = DeletionSummary()
+        now = time.time()
+        due_certificates: List[Certificate] = []
         for certificate in certificates:
-            try:
-                self.acm_client.delete_certificate(CertificateArn=certificate.arn)
-                success.append({certificate.arn: "Certificate deleted."})
-                self._delete_ssm_parameter(certificate)
-            except self.acm_client.exceptions.ResourceNotFoundException:
-                success.append({certificate.arn: "Certificate not found when attempting to delete."})
-            except self.acm_client.exceptions.ResourceInUseException:
-                failed.append({certificate.arn: "Certificate in use."})
-            except self.acm_client.exceptions.InvalidArnException:
-                failed.append({certificate.arn: "Certificate has an invalid arn."})
-            except Exception as e:
-                if certificate:
-                    failed.append({certificate.arn: f"Uknown exception: {e}"})
-                else:
-                    failed.append({"None": "Empty certificate specified."})
-        return success, failed
-
-    def request_certificate(self, identifier: str, domain_names: List[str]):
-        """
-        Request a certificate in ACM. The certificate's Tags.IDENTIFIER is set to the identifier argument
-        and its Tags.STATE is set to States.PENDING. Mark all previously pending certificates with the same identifier for deletion.
+            if not certificate:
+                summary.failed["None"] = "Empty certificate specified."
+            elif float(certificate.metadata.get(Tags.DELETE_AFTER, 0)) > now:
+                summary.deferred.append(certificate.arn)
+            else:
+                due_certificates.append(certificate)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            outcomes = list(executor.map(self._delete_certificate, due_certificates))
+
+        in_use_certificates: List[Certificate] = []
+        for certificate, (outcome, description) in zip(due_certificates, outcomes):
+            if outcome == "failed":
+                summary.failed[certificate.arn] = description
+                continue
+            getattr(summary, outcome).append(certificate.arn)
+            if outcome == "in_use":
+                in_use_certificates.append(certificate)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(self._defer_deletion, in_use_certificates))
+        self._delete_ssm_parameters(
+            [certificate for certificate in due_certificates if certificate.arn in summary.deleted]
+        )
+        self.metrics.increment("CertificatesDeleted", len(summary.deleted))
+        self.metrics.increment("CertificatesInUse", len(summary.in_use))
+        self.metrics.increment("DeletionsFailed", len(summary.failed))
+        return summary
+
+    @staticmethod
+    def domains_hash(domain_names: Iterable[str]) -> str:
         """
+        Returns a hash of a set of domains, which does not depend on their order, case or trailing dots
+        """
+        normalized_domains = sorted({domain.lower().rstrip(".") for domain in domain_names})
+        return hashlib.sha256("\n".join(normalized_domains).encode("utf-8")).hexdigest()
+
+    def request_certificate(
+        self,
+        identifier: str,
+        domain_names: List[str],
+        replaces: Optional[Certificate] = None,
+        metadata: Optional[Dict[Tags, str]] = None,
+    ) -> Certificate:
+        """
+        Request a certificate in ACM. The certificate's Tags.IDENTIFIER is set to the identifier argument,
+        its Tags.STATE is set to States.PENDING and its Tags.DOMAINS_HASH to the hash of domain_names.
+        Mark all previously pending certificates with the same identifier for deletion, as well as the ones
+        it gave up retrying (see retry()).
+        If a pending or available certificate with the same identifier was already requested for the same domains,
+        no certificate is requested and the existing one is returned instead, so requesting the same domains again is a no-op.
+        When that is the available certificate, pending certificates with other domains are marked for deletion.
+        The idempotency token is derived from the identifier and the domains, so that requests repeated within an hour
+        (e.g. when a lambda invocation is retried) return the same certificate from ACM.
+        When the request replaces a certificate (e.g. one that failed validation), that certificate is not considered
+        as an existing one, and its ARN is part of the idempotency token so that a new certificate is issued.
+        Neither is the certificate in Tags.REPLACES of the metadata, so that retrying a renewal (see renew())
+        does not return the available certificate it renews.
+        Additional certifier tags (e.g. Tags.SOURCE_ETAG) can be passed in metadata, they are also updated
+        on the existing certificate when no certificate is requested.
+        """
+        metadata = metadata or {}
+        domains_hash = self.domains_hash(domain_names)
+        replaced_arns = {metadata.get(Tags.REPLACES)} | ({replaces.arn} if replaces is not None else set())
         pending_certificates = self.query(identifier=identifier, state=States.PENDING)
+        for certificate in pending_certificates + self.query(identifier=identifier, state=States.AVAILABLE):
+            if certificate.metadata.get(Tags.DOMAINS_HASH) == domains_hash and certificate.arn not in replaced_arns:
+                print(f"Certificate with the same domains already requested, skipping request: {certificate}")
+                self.metrics.increment("CertificateRequestsSkipped")
+                changed_metadata = {
+                    tag: value for tag, value in metadata.items() if certificate.metadata.get(tag) != value
+                }
+                if changed_metadata:
+                    self._add_tags(certificate, changed_metadata)
+                if certificate.state == States.AVAILABLE:
+                    # The domains were changed back before the pending certificates were issued, which would
+                    # otherwise replace the available certificate with domains that are no longer requested
+                    self.mark_for_deletion(pending_certificates)
+                return certificate
+
         certificate_tags = [
             {"Key": Tags.IDENTIFIER.value, "Value": identifier},
             {"Key": Tags.STATE.value, "Value": States.PENDING.value},
-        ]
+            {"Key": Tags.DOMAINS_HASH.value, "Value": domains_hash},
+        ] + [{"Key": tag.value, "Value": value} for tag, value in metadata.items()]
+        idempotency_key = "\n".join([identifier, domains_hash] + ([replaces.arn] if replaces is not None else []))
         request_certificate_args = {
             "DomainName": domain_names[0],
             "ValidationMethod": "DNS",
-            "IdempotencyToken": "".join([random.choice(string.ascii_letters) for _ in range(32)]),
+            # ACM idempotency tokens are limited to 32 characters
+            "IdempotencyToken": hashlib.sha256(idempotency_key.encode("utf-8")).hexdigest()[:32],
         }
         if len(domain_names) > 1:
             request_certificate_args["SubjectAlternativeNames"] = domain_names[1::]
@@ -217,44 +912,213 @@ class actions:
         self.acm_client.add_tags_to_certificate(
             CertificateArn=requested_certificate["CertificateArn"], Tags=certificate_tags
         )
-        self.mark_for_deletion(pending_certificates)
+        certificate = Certificate(
+            identifier,
+            requested_certificate["CertificateArn"],
+            States.PENDING,
+            metadata={Tags.DOMAINS_HASH: domains_hash, **metadata},
+        )
+        self._remember(certificate)
+        self.metrics.increment("CertificatesRequested")
+        # A repeated request returns the certificate requested the first time, which must not be marked
+        self.mark_for_deletion(
+            [
+                previous
+                for previous in pending_certificates + self.query(identifier=identifier, state=States.GAVE_UP)
+                if previous.arn != requested_certificate["CertificateArn"]
+            ]
+        )
+        return certificate
 
     def transition_to_available(self, certificates: List[Certificate]) -> None:
         """
         Transition the certificates passed as argument to the States.AVAILABLE state
         so long as its previous state was States.PENDING. Mark previously available certificates
         with the same identifier for deletion.
+        When several certificates of the same identifier are passed, only the one issued last (see describe())
+        is transitioned and the others are marked for deletion, as they were superseded.
+        All tag changes are planned first and then applied concurrently, so the number of requests
+        depends on the number of identifiers transitioned only.
+        The certificates' ARNs are published in Parameter Store once flush() is called.
         """
+        candidates: Dict[str, List[Certificate]] = {}
         for certificate in certificates:
             if certificate.state == States.PENDING:
-                previous_available = self.query(identifier=certificate.identifier, state=States.AVAILABLE)
-                self.acm_client.add_tags_to_certificate(
-                    CertificateArn=certificate.arn,
-                    Tags=({"Key": Tags.STATE.value, "Value": States.AVAILABLE.value},),
-                )
-                self.mark_for_deletion(previous_available)
-                self.ssm_client.put_parameter(
-                    Name=f"/certifier/{certificate.identifier}",
-                    Value=certificate.arn,
-                    Type="String",
-                    Overwrite=True,
-                )
+                candidates.setdefault(certificate.identifier, []).append(certificate)
+        if not candidates:
+            return
+
+        transitioned = {
+            identifier: max(
+                identifier_candidates,
+                key=lambda certificate: (
+                    certificate.issued_at.timestamp() if certificate.issued_at is not None else 0,
+                    certificate.arn,
+                ),
+            )
+            for identifier, identifier_candidates in candidates.items()
+        }
+        previous_available = self._get_available_by_identifier(list(transitioned))
+        superseded = [
+            certificate
+            for identifier, identifier_certificates in candidates.items()
+            for certificate in identifier_certificates + previous_available[identifier]
+            if certificate.arn != transitioned[identifier].arn
+        ]
 
-    def retry(self, certificate: Certificate):
+        def apply_state(change: Tuple[Certificate, States]) -> None:
+            self._add_tags(change[0], {Tags.STATE: change[1].value})
+
+        changes = [(certificate, States.AVAILABLE) for certificate in transitioned.values()] + [
+            (certificate, States.MARKED_FOR_DELETION) for certificate in superseded
+        ]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(apply_state, changes))
+        for identifier, certificate in transitioned.items():
+            self.parameters.put(identifier, certificate.arn)
+        self.metrics.increment("CertificatesTransitioned", len(transitioned))
+        self.metrics.increment("CertificatesMarkedForDeletion", len(superseded))
+
+    @staticmethod
+    def waiting_for_retry(certificate: Certificate, now: Optional[float] = None) -> bool:
+        """
+        Returns whether a certificate that failed validation is scheduled to be retried later, see retry().
+        As failing validation is final in ACM, such certificates do not need to be described until then.
         """
-        Determine which domains are part of the certificate and request it again.
-        Mark retried certificate for deletion.
+        return float(certificate.metadata.get(Tags.RETRY_AFTER, 0)) > (time.time() if now is None else now)
+
+    def retry(self, certificate: Certificate) -> Optional[Certificate]:
         """
-        domains = self._get_domains_for_certificate(certificate)
+        Request a certificate that failed validation again, with the same domains, returning the new certificate.
+        The number of retries of an identifier is carried over in Tags.RETRY_ATTEMPTS of each new certificate,
+        the first failure is retried right away and later ones after a delay doubling with every retry
+        up to self.max_retry_delay, which is tagged in Tags.RETRY_AFTER of the failed certificate.
+        None is returned while the retry is not due, see waiting_for_retry(),
+        and once the identifier failed self.max_retries times, as the certificate is then moved to States.GAVE_UP.
+        Retried certificates are marked for deletion.
+        """
+        attempts = int(certificate.metadata.get(Tags.RETRY_ATTEMPTS, 0))
+        if Tags.RETRY_AFTER not in certificate.metadata:
+            self.metrics.increment("CertificatesFailed")
+            if attempts >= self.max_retries:
+                print(f"Giving up on certificate after {attempts} retries: {certificate}")
+                self._add_tags(certificate, {Tags.STATE: States.GAVE_UP.value})
+                self.metrics.increment("CertificatesGaveUp")
+                return None
+            if attempts > 0:
+                delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+                self._add_tags(certificate, {Tags.RETRY_AFTER: str(int(time.time() + delay))})
+                return None
+        elif self.waiting_for_retry(certificate):
+            return None
+
+        domains = certificate.domains or self._get_domains_for_certificate(certificate)
+        metadata = {Tags.RETRY_ATTEMPTS: str(attempts + 1), **self._source_metadata(certificate)}
         # request_certificate will also mark the retried certificate for deletion
-        self.request_certificate(certificate.identifier, domains)
+        return self.request_certificate(certificate.identifier, domains, replaces=certificate, metadata=metadata)
+
+    def check_health(
+        self,
+        certificates: List[Certificate],
+        warning_days: int = 30,
+        critical_days: int = 7,
+        now: Optional[datetime] = None,
+    ) -> HealthReport:
+        """
+        Describes the certificates in a single concurrent pass (see describe()) and classifies them by the days
+        left before their NotAfter date and by the status of their managed renewal, returning a HealthReport.
+        The number of certificates in each class is counted in self.metrics.
+        """
+        now = now or datetime.now(timezone.utc)
+        self.describe(certificates)
+        report = HealthReport()
+        for certificate in certificates:
+            if certificate.renewal_status in ("FAILED", "PENDING_VALIDATION"):
+                report.renewal_stuck.append(certificate.arn)
+            if certificate.not_after is None:
+                if certificate.arn not in report.renewal_stuck:
+                    report.healthy.append(certificate.arn)
+                continue
+            days_to_expiry = (certificate.not_after - now).days
+            report.days_to_expiry[certificate.arn] = days_to_expiry
+            if certificate.not_after <= now:
+                report.expired.append(certificate.arn)
+            elif days_to_expiry < critical_days:
+                report.critical.append(certificate.arn)
+            elif days_to_expiry < warning_days:
+                report.expiring.append(certificate.arn)
+            elif certificate.arn not in report.renewal_stuck:
+                report.healthy.append(certificate.arn)
+        self.metrics.increment("CertificatesExpired", len(report.expired))
+        self.metrics.increment("CertificatesExpiringCritically", len(report.critical))
+        self.metrics.increment("CertificatesExpiring", len(report.expiring))
+        self.metrics.increment("CertificatesRenewalStuck", len(report.renewal_stuck))
+        return report
+
+    def renew(self, certificate: Certificate) -> Optional[Certificate]:
+        """
+        Requests a certificate again with the same domains, e.g. when it is about to expire
+        and its managed renewal is stuck, returning the new certificate. It replaces the certificate
+        once it is issued and transitioned, like any other request. The renewed certificate is tagged
+        in Tags.REPLACES of the new one, which is carried over when it is retried (see retry()).
+        No certificate is requested and None is returned while the identifier has a pending certificate,
+        either a previous renewal or a newer version of its domains, which will replace it anyway.
+        """
+        pending_certificates = self.query(identifier=certificate.identifier, state=States.PENDING)
+        if pending_certificates:
+            print(f"Certificate already has a pending replacement, skipping renewal: {certificate}")
+            self.metrics.increment("CertificateRenewalsSkipped")
+            return None
+        domains = certificate.domains or self._get_domains_for_certificate(certificate)
+        self.metrics.increment("CertificatesRenewed")
+        metadata = {**self._source_metadata(certificate), Tags.REPLACES: certificate.arn}
+        return self.request_certificate(certificate.identifier, domains, replaces=certificate, metadata=metadata)
+
+    @staticmethod
+    def _source_metadata(certificate: Certificate) -> Dict[Tags, str]:
+        """
+        Returns the tags of a certificate to carry over to the certificates requested to replace it
+        """
+        return {
+            tag: value
+            for tag, value in certificate.metadata.items()
+            if tag in (Tags.SOURCE_ETAG, Tags.REPLACES, Tags.SHARDS)
+        }
 
     def _get_domains_for_certificate(self, certificate) -> List[str]:
         """
         Describe the certificate in ACM to obtain the list of SubjectAlternativeNames and the DomainName it was requested with
         """
-        certificate_data = self.acm_client.describe_certificate(CertificateArn=certificate.arn)["Certificate"]
-        return [certificate_data["DomainName"]] + certificate_data["SubjectAlternativeNames"]
+        return self._domains_from_description(self._describe_certificate(certificate.arn))
+
+    def flush(self) -> None:
+        """
+        Sends pending writes to Parameter Store
+        """
+        if self._parameters is not None:
+            self._parameters.flush()
+
+    def get_sweep_cursor(self, sweep: str) -> Optional[str]:
+        """
+        Returns the cursor saved by the last incomplete run of a sweep, or None if the last run completed
+        """
+        try:
+            return self.ssm_client.get_parameter(Name=f"/certifier-sweeps/{sweep}")["Parameter"]["Value"]
+        except self.ssm_client.exceptions.ParameterNotFound:
+            return None
+
+    def set_sweep_cursor(self, sweep: str, cursor: Optional[str]) -> None:
+        """
+        Saves the cursor from which the next run of a sweep should continue, or removes it when cursor is None
+        """
+        ssm_parameter_name = f"/certifier-sweeps/{sweep}"
+        if cursor is not None:
+            self.ssm_client.put_parameter(Name=ssm_parameter_name, Value=cursor, Type="String", Overwrite=True)
+            return
+        try:
+            self.ssm_client.delete_parameter(Name=ssm_parameter_name)
+        except self.ssm_client.exceptions.ParameterNotFound:
+            pass
 
     def sns_notify(self, sns_topic_url: str, subject: str, message: str):
         pass
@@ -0,0 +1,56 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import threading
+from typing import Optional
+import boto3  # type: ignore
+from botocore.config import Config  # type: ignore
+
+# Connections kept open per client, which also bounds how many requests certifier sends concurrently.
+# botocore retries throttled requests itself, backing off exponentially, the rate limiter only paces them.
+# Timeouts are kept short, so a stuck connection is retried well before the lambda times out.
+CLIENT_CONFIG = Config(
+    max_pool_connections=16,
+    retries={"mode": "standard", "max_attempts": 6},
+    connect_timeout=5,
+    read_timeout=20,
+    tcp_keepalive=True,
+)
+
+_session: Optional[boto3.session.Session] = None
+_lock = threading.Lock()
+
+
+def get_session() -> boto3.session.Session:
+    """
+    Returns the boto3 session shared by all clients, creating it on first use
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session
+
+
+def create_client(service: str, region: Optional[str] = None):
+    """
+    Creates a client for the service from the shared session, using CLIENT_CONFIG.
+    Sessions are not thread-safe, so clients are created one at a time.
+    """
+    session = get_session()
+    with _lock:
+        return session.client(service, region_name=region, config=CLIENT_CONFIG)
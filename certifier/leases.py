@@ -0,0 +1,119 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Generator, Iterable, Optional, Set
+
+# Longest time to wait between attempts to acquire a lease held by someone else, in seconds
+MAX_RETRY_DELAY = 2.0
+
+
+class LeaseUnavailable(Exception):
+    """
+    Raised when a name stays leased by someone else for longer than the caller was willing to wait
+    """
+
+
+class DynamoDBLeases:
+    """
+    Exclusive leases on names, so that concurrent invocations do not work on the same certificates at the same time.
+    A lease is an item in a DynamoDB table keyed by "name", created with a conditional write that only succeeds
+    if there is no item for the name or if it expired. Leases expire after 'ttl' seconds, so a lease that was
+    never released (e.g. when a lambda timed out) does not block the name forever. The "expires_at" attribute
+    can be used as the time to live attribute of the table, to have DynamoDB remove expired leases.
+    """
+
+    def __init__(self, dynamodb_client, table_name: str, ttl: float = 300, max_workers: int = 10):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+        self.ttl = ttl
+        self.max_workers = max_workers
+
+    def create_table(self) -> None:
+        """
+        Creates the table with on-demand capacity, see serverless.yml for the same table as a CloudFormation resource
+        """
+        self.dynamodb_client.create_table(
+            TableName=self.table_name,
+            BillingMode="PAY_PER_REQUEST",
+            AttributeDefinitions=[{"AttributeName": "name", "AttributeType": "S"}],
+            KeySchema=[{"AttributeName": "name", "KeyType": "HASH"}],
+        )
+        self.dynamodb_client.update_time_to_live(
+            TableName=self.table_name, TimeToLiveSpecification={"Enabled": True, "AttributeName": "expires_at"}
+        )
+
+    def acquire(self, name: str, wait: float = 0) -> Optional[str]:
+        """
+        Acquires the lease on a name, returning the token needed to release it, or None if the name is leased
+        by someone else. Attempts are repeated with an exponential backoff for up to 'wait' seconds.
+        """
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + wait
+        delay = 0.1
+        while True:
+            now = time.time()
+            try:
+                self.dynamodb_client.put_item(
+                    TableName=self.table_name,
+                    Item={"name": {"S": name}, "owner": {"S": token}, "expires_at": {"N": str(int(now + self.ttl))}},
+                    ConditionExpression="attribute_not_exists(#name) OR expires_at < :now",
+                    ExpressionAttributeNames={"#name": "name"},
+                    ExpressionAttributeValues={":now": {"N": str(int(now))}},
+                )
+                return token
+            except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+                if time.monotonic() + delay > deadline:
+                    return None
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def release(self, name: str, token: str) -> None:
+        """
+        Releases the lease on a name, unless it expired and was acquired by someone else in the meantime
+        """
+        try:
+            self.dynamodb_client.delete_item(
+                TableName=self.table_name,
+                Key={"name": {"S": name}},
+                ConditionExpression="#owner = :token",
+                ExpressionAttributeNames={"#owner": "owner"},
+                ExpressionAttributeValues={":token": {"S": token}},
+            )
+        except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+            print(f"Lease on {name} expired before it was released")
+
+    @contextmanager
+    def hold(self, names: Iterable[str], wait: float = 0) -> Generator[Set[str], None, None]:
+        """
+        Acquires the leases on the names concurrently, yielding the names that were leased,
+        and releases them when the block exits
+        """
+        names = set(names)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            tokens: Dict[str, Optional[str]] = dict(
+                zip(names, executor.map(lambda name: self.acquire(name, wait), names))
+            )
+        leased = {name: token for name, token in tokens.items() if token is not None}
+        try:
+            yield set(leased)
+        finally:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(lambda name: self.release(name, leased[name]), leased))
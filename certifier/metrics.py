@@ -0,0 +1,146 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+from .throttling import THROTTLING_ERROR_CODES
+
+# CloudWatch accepts at most 100 values for a metric, and 100 metrics per directive,
+# in a single Embedded Metric Format log line
+MAX_VALUES = 100
+MAX_METRICS = 100
+
+
+class Metrics:
+    """
+    Collects metrics about the AWS API calls made by the boto clients it is installed on, and any counters
+    incremented by the application, and emits them as a single CloudWatch Embedded Metric Format (EMF) log line.
+    API metrics are named after the service and operation, like "acm.DescribeCertificate.Calls":
+    * Calls: number of calls made, retries excluded.
+    * Latency: duration of each call in milliseconds, retries included.
+    * Retries: number of retries.
+    * Throttles: number of attempts rejected by throttling.
+    * Errors: number of calls that failed without a response, like connection errors.
+    """
+
+    def __init__(self, namespace: str = "Certifier"):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Discards all collected metrics
+        """
+        with self._lock:
+            self.counters: Dict[str, int] = Counter()
+            self.latencies: Dict[str, List[float]] = {}
+
+    def install(self, client):
+        """
+        Registers the metrics collection on the client's events and returns the client
+        """
+        client.meta.events.register("before-call", self._before_call)
+        client.meta.events.register("after-call", self._after_call)
+        client.meta.events.register("after-call-error", self._after_call_error)
+        client.meta.events.register("needs-retry", self._needs_retry)
+        return client
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, milliseconds: float) -> None:
+        """
+        Records a duration, durations with the same name are emitted together as the values of a single metric
+        """
+        with self._lock:
+            self.latencies.setdefault(name, []).append(milliseconds)
+
+    @staticmethod
+    def _operation_metric(model) -> str:
+        return f"{model.service_model.service_id.hyphenize()}.{model.name}"
+
+    def _before_call(self, model, context, **kwargs) -> None:
+        context["certifier_call_started"] = time.perf_counter()
+        context["certifier_call_model"] = model
+        self.increment(f"{self._operation_metric(model)}.Calls")
+
+    def _after_call(self, model, context, parsed=None, **kwargs) -> None:
+        latency = (time.perf_counter() - context.get("certifier_call_started", time.perf_counter())) * 1000
+        retries = (parsed or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        self.observe(f"{self._operation_metric(model)}.Latency", latency)
+        if retries:
+            self.increment(f"{self._operation_metric(model)}.Retries", retries)
+
+    def _after_call_error(self, context, exception=None, **kwargs) -> None:
+        # botocore emits "after-call-error" without the operation model, which is kept in the context by _before_call
+        model = context.get("certifier_call_model")
+        if model is None:
+            return
+        latency = (time.perf_counter() - context.get("certifier_call_started", time.perf_counter())) * 1000
+        self.observe(f"{self._operation_metric(model)}.Latency", latency)
+        self.increment(f"{self._operation_metric(model)}.Errors")
+
+    def _needs_retry(self, operation, response=None, **kwargs) -> None:
+        if response is not None and response[1].get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+            self.increment(f"{self._operation_metric(operation)}.Throttles")
+
+    @staticmethod
+    def _summarize(values: List[float]) -> List[float]:
+        """
+        Returns the values as they are if there are at most MAX_VALUES of them,
+        otherwise MAX_VALUES evenly spaced percentiles of the values
+        """
+        if len(values) <= MAX_VALUES:
+            return values
+        ordered = sorted(values)
+        return [ordered[round(index * (len(ordered) - 1) / (MAX_VALUES - 1))] for index in range(MAX_VALUES)]
+
+    def emit(self, dimensions: Optional[Dict[str, str]] = None) -> Dict:
+        """
+        Prints the collected metrics as an EMF log line, returning the EMF document
+        """
+        dimensions = dimensions or {}
+        with self._lock:
+            values = {name: count for name, count in self.counters.items()}
+            units = {name: "Count" for name in values}
+            for name, latencies in self.latencies.items():
+                values[name] = self._summarize(latencies)
+                units[name] = "Milliseconds"
+
+        names = sorted(values)
+        document: Dict = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [sorted(dimensions)],
+                        "Metrics": [{"Name": name, "Unit": units[name]} for name in names[start : start + MAX_METRICS]],
+                    }
+                    for start in range(0, len(names), MAX_METRICS)
+                ],
+            },
+            **dimensions,
+            **values,
+        }
+        print(json.dumps(document))
+        return document
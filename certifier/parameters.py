@@ -0,0 +1,101 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Set
+
+# Most parameters allowed by the GetParameters and DeleteParameters APIs in a single request
+BATCH_SIZE = 10
+
+
+class ParameterStore:
+    """
+    Reads and writes the SSM parameters in which certifier publishes the ARN of the available certificate
+    of each identifier, named after the identifier and prepended with 'prefix'.
+    Parameters are read and deleted in batches. Writes are queued until flush() is called,
+    at which point they are sent concurrently, only the last value queued for each parameter being written.
+    """
+
+    def __init__(self, ssm_client, max_workers: int = 10, prefix: str = "/certifier/"):
+        self.ssm_client = ssm_client
+        self.max_workers = max_workers
+        self.prefix = prefix
+        self._queued_puts: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def name(self, identifier: str) -> str:
+        return f"{self.prefix}{identifier}"
+
+    def _get_parameters(self, names: List[str]) -> Dict[str, str]:
+        """
+        Returns the values of the existing parameters among names, by name
+        """
+        values: Dict[str, str] = {}
+        for start in range(0, len(names), BATCH_SIZE):
+            response = self.ssm_client.get_parameters(Names=names[start : start + BATCH_SIZE])
+            values.update({parameter["Name"]: parameter["Value"] for parameter in response.get("Parameters", [])})
+        return values
+
+    def get(self, identifiers: Iterable[str]) -> Dict[str, str]:
+        """
+        Returns the values of the parameters of the identifiers by identifier, including queued writes.
+        Identifiers without a parameter are left out.
+        """
+        names = {self.name(identifier): identifier for identifier in identifiers}
+        with self._lock:
+            queued = {name: self._queued_puts[name] for name in names if name in self._queued_puts}
+        values = self._get_parameters([name for name in names if name not in queued])
+        values.update(queued)
+        return {names[name]: value for name, value in values.items()}
+
+    def put(self, identifier: str, value: str) -> None:
+        """
+        Queues a write of the parameter of the identifier, sent by the next flush()
+        """
+        with self._lock:
+            self._queued_puts[self.name(identifier)] = value
+
+    def flush(self) -> None:
+        """
+        Sends all queued writes concurrently
+        """
+        with self._lock:
+            queued_puts, self._queued_puts = self._queued_puts, {}
+
+        def put_parameter(name: str) -> None:
+            self.ssm_client.put_parameter(Name=name, Value=queued_puts[name], Type="String", Overwrite=True)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(put_parameter, queued_puts))
+
+    def delete_if_matches(self, expected_values: Dict[str, Set[str]]) -> List[str]:
+        """
+        Deletes the parameters of the identifiers in expected_values, so long as their value
+        is one of the values expected for the identifier. Returns the identifiers whose parameter was deleted.
+        """
+        current_values = self.get(expected_values)
+        identifiers = [
+            identifier for identifier, value in current_values.items() if value in expected_values[identifier]
+        ]
+        with self._lock:
+            for identifier in identifiers:
+                self._queued_puts.pop(self.name(identifier), None)
+        names = [self.name(identifier) for identifier in identifiers]
+        for start in range(0, len(names), BATCH_SIZE):
+            self.ssm_client.delete_parameters(Names=names[start : start + BATCH_SIZE])
+        return identifiers
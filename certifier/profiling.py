@@ -0,0 +1,88 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import cProfile
+import io
+import marshal
+import pstats
+import threading
+import tracemalloc
+from typing import List, Optional
+
+
+class Profile:
+    """
+    Profiles a block of code with cProfile and traces its memory allocations with tracemalloc.
+    cProfile only profiles the thread it is enabled in, so a profiler is also enabled in each thread started
+    within the block (e.g. by a ThreadPoolExecutor), and their stats are merged.
+    Only one Profile should be active at a time, as the thread hook and tracemalloc are global.
+    """
+
+    def __init__(self, top: int = 30):
+        self.top = top
+        self._lock = threading.Lock()
+        self._profilers: List[cProfile.Profile] = []
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._peak = 0
+
+    def _profile_thread(self, frame, event, arg) -> None:
+        # Called on the first event of each thread started while profiling, the profiler then replaces this hook
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._profilers.append(profiler)
+        profiler.enable()
+
+    def __enter__(self) -> "Profile":
+        tracemalloc.start()
+        self._profilers = [cProfile.Profile()]
+        threading.setprofile(self._profile_thread)
+        self._profilers[0].enable()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._profilers[0].disable()
+        threading.setprofile(None)
+        self._snapshot = tracemalloc.take_snapshot()
+        self._peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    def stats(self, stream=None) -> pstats.Stats:
+        """
+        Returns the stats of all profiled threads merged together
+        """
+        with self._lock:
+            return pstats.Stats(*self._profilers, stream=stream)
+
+    def dump(self) -> bytes:
+        """
+        Returns the stats in the format of cProfile output files, which pstats and tools like snakeviz can read
+        """
+        return marshal.dumps(self.stats().stats)
+
+    def report(self) -> str:
+        """
+        Returns the functions with the highest cumulative time and the lines that allocated the most memory
+        still allocated at the end of the block, along with the peak of traced memory
+        """
+        stream = io.StringIO()
+        self.stats(stream).sort_stats("cumulative").print_stats(self.top)
+        stream.write(f"Peak traced memory: {self._peak / 1024:.1f} KiB\n")
+        stream.write(f"Top {self.top} allocation sites:\n")
+        if self._snapshot is not None:
+            for statistic in self._snapshot.statistics("lineno")[: self.top]:
+                stream.write(f"{statistic}\n")
+        return stream.getvalue()
@@ -0,0 +1,140 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Generator, List, Optional, Tuple
+
+# Most requests allowed by the BatchWriteItem API in a single call
+BATCH_SIZE = 25
+# Index by state, sorted by identifier, and index by identifier, sorted by state
+STATE_INDEX = "state-identifier"
+IDENTIFIER_INDEX = "identifier-state"
+
+
+class DynamoDBStateStore:
+    """
+    Mirrors the certifier tags of each certificate in a DynamoDB table, so certificates can be looked up
+    by state and identifier with a single index read instead of listing all certificates and their tags in ACM.
+    Items are keyed by certificate ARN, with the "identifier" and "state" attributes indexed, the certifier tags
+    by key under "tags", and the time the item was first and last written under "created_at" and "updated_at".
+    Tags in ACM remain the source of truth, see rebuild() to restore the table from them.
+    """
+
+    def __init__(self, dynamodb_client, table_name: str, max_workers: int = 10):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+        self.max_workers = max_workers
+
+    def create_table(self) -> None:
+        """
+        Creates the table with on-demand capacity, see serverless.yml for the same table as a CloudFormation resource
+        """
+        self.dynamodb_client.create_table(
+            TableName=self.table_name,
+            BillingMode="PAY_PER_REQUEST",
+            AttributeDefinitions=[
+                {"AttributeName": name, "AttributeType": "S"} for name in ("arn", "identifier", "state")
+            ],
+            KeySchema=[{"AttributeName": "arn", "KeyType": "HASH"}],
+            GlobalSecondaryIndexes=[
+                {
+                    "IndexName": index,
+                    "KeySchema": [
+                        {"AttributeName": hash_key, "KeyType": "HASH"},
+                        {"AttributeName": range_key, "KeyType": "RANGE"},
+                    ],
+                    "Projection": {"ProjectionType": "ALL"},
+                }
+                for index, hash_key, range_key in (
+                    (STATE_INDEX, "state", "identifier"),
+                    (IDENTIFIER_INDEX, "identifier", "state"),
+                )
+            ],
+        )
+
+    def put(self, arn: str, identifier: str, state: str, tags: Dict[str, str]) -> None:
+        """
+        Writes the identifier, state and certifier tags by tag key of a certificate
+        """
+        now = str(int(time.time()))
+        self.dynamodb_client.update_item(
+            TableName=self.table_name,
+            Key={"arn": {"S": arn}},
+            UpdateExpression=(
+                "SET identifier = :identifier, #state = :state, tags = :tags, "
+                "updated_at = :now, created_at = if_not_exists(created_at, :now)"
+            ),
+            ExpressionAttributeNames={"#state": "state"},
+            ExpressionAttributeValues={
+                ":identifier": {"S": identifier},
+                ":state": {"S": state},
+                ":tags": {"M": {key: {"S": value} for key, value in tags.items()}},
+                ":now": {"N": now},
+            },
+        )
+
+    def delete(self, arn: str) -> None:
+        self.dynamodb_client.delete_item(TableName=self.table_name, Key={"arn": {"S": arn}})
+
+    def _items(self, identifier: Optional[str], state: Optional[str]) -> Generator[Dict, None, None]:
+        if identifier is None and state is None:
+            pages = self.dynamodb_client.get_paginator("scan").paginate(TableName=self.table_name)
+        else:
+            conditions = {"identifier": identifier, "state": state}
+            attribute_names = {f"#{name}": name for name, value in conditions.items() if value is not None}
+            pages = self.dynamodb_client.get_paginator("query").paginate(
+                TableName=self.table_name,
+                IndexName=STATE_INDEX if state is not None else IDENTIFIER_INDEX,
+                KeyConditionExpression=" AND ".join(f"{name} = :{name[1:]}" for name in attribute_names),
+                ExpressionAttributeNames=attribute_names,
+                ExpressionAttributeValues={
+                    f":{name}": {"S": value} for name, value in conditions.items() if value is not None
+                },
+            )
+        for page in pages:
+            yield from page["Items"]
+
+    def query(self, identifier: Optional[str] = None, state: Optional[str] = None) -> Dict[str, Dict[str, str]]:
+        """
+        Returns the certifier tags by ARN of the certificates with the identifier and state, either of which can be omitted.
+        Queries use the index of the state when it is given, or the index of the identifier otherwise,
+        the table is only scanned when neither is given.
+        """
+        return {
+            item["arn"]["S"]: {key: value["S"] for key, value in item["tags"]["M"].items()}
+            for item in self._items(identifier, state)
+        }
+
+    def rebuild(self, certificates: Dict[str, Tuple[str, str, Dict[str, str]]]) -> List[str]:
+        """
+        Replaces the contents of the table with the (identifier, state, tags) by ARN of all certificates in ACM,
+        returning the ARNs of the items that were deleted since their certificate no longer exists.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(lambda arn: self.put(arn, *certificates[arn]), certificates))
+
+        stale_arns = [arn for arn in self.query() if arn not in certificates]
+        for start in range(0, len(stale_arns), BATCH_SIZE):
+            requests = {
+                self.table_name: [
+                    {"DeleteRequest": {"Key": {"arn": {"S": arn}}}} for arn in stale_arns[start : start + BATCH_SIZE]
+                ]
+            }
+            while requests:
+                requests = self.dynamodb_client.batch_write_item(RequestItems=requests).get("UnprocessedItems")
+        return stale_arns
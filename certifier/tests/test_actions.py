@@ -17,12 +17,36 @@
 
 import json
 import time
+from datetime import datetime, timedelta, timezone
 import pytest
 from certifier import certifier
 
 
-# Cannot be tested with moto atm: https://github.com/spulec/moto/blob/master/moto/acm/responses.py#L211
-# def test_get_records(acm_client):
+def test_get_records(acm_client):
+    actions = certifier.actions()
+    certificate = actions.query(state=certifier.States.PENDING)[0]
+    records = actions._get_records(certificate.arn)
+    assert len(records) == 5
+    assert all(name.endswith("example.com.") for name, _ in records)
+
+
+def test_describe_once_per_certificate(acm_client):
+    actions = certifier.actions()
+    described = []
+    actions.acm_client.meta.events.register(
+        "before-parameter-build.acm.DescribeCertificate",
+        lambda params, **kwargs: described.append(params["CertificateArn"]),
+    )
+    certificates = actions.query(with_records=True, with_acm_state=True)
+    assert sorted(described) == sorted(certificate.arn for certificate in certificates)
+    for certificate in certificates:
+        assert certificate.acm_state == "PENDING_VALIDATION"
+        assert len(certificate.records) == 5
+        assert certificate.domains[0] == "0.example.com" and len(certificate.domains) == 5
+        assert certificate.not_after is not None
+        assert certificate.in_use_by == []
+    actions.retry(certificates[0])
+    assert len(described) == len(certificates)
 
 
 def test_query_with_acm_state(acm_client):
@@ -54,6 +78,31 @@ def test_certificate_transition(acm_client, ssm_client):
     assert len(available_certificates) == 1
 
 
+def test_transition_newest_issued(acm_client, ssm_client):
+    actions = certifier.actions()
+    previous = actions.query(identifier="certificate1", state=certifier.States.AVAILABLE)[0]
+    newest = actions.query(identifier="certificate1", state=certifier.States.PENDING)[0]
+    oldest = certifier.Certificate(
+        "certificate1",
+        acm_client.request_certificate(DomainName="0.example.com", ValidationMethod="DNS")["CertificateArn"],
+        certifier.States.PENDING,
+    )
+    acm_client.add_tags_to_certificate(
+        CertificateArn=oldest.arn,
+        Tags=[{"Key": tag.value, "Value": value} for tag, value in oldest.certifier_tags().items()],
+    )
+    newest.issued_at = datetime(2020, 1, 2, tzinfo=timezone.utc)
+    oldest.issued_at = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    actions.transition_to_available([newest, oldest])
+    actions.flush()
+
+    assert ssm_client.get_parameter(Name="/certifier/certificate1")["Parameter"]["Value"] == newest.arn
+    actions.reset_inventory()
+    assert [certificate.arn for certificate in actions.query(state=certifier.States.AVAILABLE)] == [newest.arn]
+    marked_certificates = actions.query(state=certifier.States.MARKED_FOR_DELETION)
+    assert {oldest.arn, previous.arn} <= {certificate.arn for certificate in marked_certificates}
+
+
 def test_get_acm_state(acm_client):
     actions = certifier.actions()
     certificate = actions.query()[0]
@@ -78,6 +127,147 @@ def test_request_certificate(acm_client):
     assert len(actions.query(identifier="certificate1", state=certifier.States.MARKED_FOR_DELETION)) >= 1
 
 
+def test_request_certificate_same_domains(acm_client):
+    actions = certifier.actions()
+    certificate = actions.request_certificate("certificate2", ["a.example.com", "b.example.com"])
+    assert certificate.metadata[certifier.Tags.DOMAINS_HASH] == actions.domains_hash(
+        ["B.example.com.", "a.example.com"]
+    )
+    assert actions.request_certificate("certificate2", ["b.example.com", "a.example.com"]) == certificate
+    assert actions.query(identifier="certificate2") == [certificate]
+    actions.request_certificate("certificate2", ["a.example.com"])
+    assert len(actions.query(identifier="certificate2", state=certifier.States.PENDING)) == 1
+    assert (
+        actions.query(identifier="certificate2", state=certifier.States.MARKED_FOR_DELETION)[0].arn == certificate.arn
+    )
+
+
+def test_request_certificate_idempotency_token(acm_client):
+    certificate = certifier.actions().request_certificate("certificate2", ["a.example.com"])
+    # A new actions object does not know about the first request, as if the tags were never added
+    acm_client.remove_tags_from_certificate(
+        CertificateArn=certificate.arn, Tags=[{"Key": tag.value} for tag in certificate.certifier_tags()]
+    )
+    actions = certifier.actions()
+    assert actions.request_certificate("certificate2", ["a.example.com"]).arn == certificate.arn
+    assert actions.query(identifier="certificate2", state=certifier.States.PENDING)[0].arn == certificate.arn
+
+
+def test_request_certificate_reverted_domains(acm_client, ssm_client):
+    actions = certifier.actions()
+    available = actions.request_certificate("certificate2", ["a.example.com"])
+    actions.transition_to_available([available])
+    changed = actions.request_certificate("certificate2", ["a.example.com", "b.example.com"])
+    assert actions.request_certificate("certificate2", ["a.example.com"]).arn == available.arn
+    actions = certifier.actions()
+    assert actions.query(identifier="certificate2", state=certifier.States.PENDING) == []
+    assert actions.query(identifier="certificate2", state=certifier.States.MARKED_FOR_DELETION)[0].arn == changed.arn
+    assert actions.query(identifier="certificate2", state=certifier.States.AVAILABLE)[0].arn == available.arn
+
+
+def test_retry_requests_new_certificate(acm_client):
+    actions = certifier.actions()
+    certificate = actions.request_certificate("certificate2", ["a.example.com"])
+    actions.retry(certificate)
+    pending_certificates = actions.query(identifier="certificate2", state=certifier.States.PENDING)
+    assert len(pending_certificates) == 1 and pending_certificates[0].arn != certificate.arn
+    assert (
+        actions.query(identifier="certificate2", state=certifier.States.MARKED_FOR_DELETION)[0].arn == certificate.arn
+    )
+
+
+def test_retry_backoff(acm_client):
+    actions = certifier.actions(retry_delay=0, max_retries=2)
+    certificate = actions.request_certificate("certificate2", ["a.example.com"])
+    first_retry = actions.retry(certificate)
+    assert first_retry.metadata[certifier.Tags.RETRY_ATTEMPTS] == "1"
+    # Later failures are scheduled for a retry after a delay instead of being retried right away
+    assert actions.retry(first_retry) is None
+    actions = certifier.actions(retry_delay=0, max_retries=2)
+    failed_certificate = actions.query(identifier="certificate2", state=certifier.States.PENDING)[0]
+    assert failed_certificate.arn == first_retry.arn and not actions.waiting_for_retry(failed_certificate)
+    assert actions.waiting_for_retry(failed_certificate, now=0)
+    second_retry = actions.retry(failed_certificate)
+    assert second_retry.metadata[certifier.Tags.RETRY_ATTEMPTS] == "2"
+    assert actions.retry(second_retry) is None
+    assert actions.query(identifier="certificate2", state=certifier.States.PENDING) == []
+    assert actions.query(identifier="certificate2", state=certifier.States.GAVE_UP)[0].arn == second_retry.arn
+    # A new request for the identifier starts over
+    actions.request_certificate("certificate2", ["b.example.com"])
+    assert actions.query(identifier="certificate2", state=certifier.States.GAVE_UP) == []
+
+
+def test_check_health(acm_client, monkeypatch):
+    actions = certifier.actions()
+    describe_certificate = actions._describe_certificate
+    monkeypatch.setattr(
+        actions,
+        "_describe_certificate",
+        lambda arn: {**describe_certificate(arn), "RenewalSummary": {"RenewalStatus": "PENDING_VALIDATION"}},
+    )
+    certificate = actions.query(state=certifier.States.AVAILABLE)[0]
+    report = actions.check_health([certificate])
+    assert report.healthy == [] and report.renewal_stuck == [certificate.arn] and report.at_risk() == []
+    assert certificate.renewal_status == "PENDING_VALIDATION"
+
+    report = actions.check_health([certificate], now=certificate.not_after - timedelta(days=10, hours=1))
+    assert report.expiring == [certificate.arn] and report.days_to_expiry[certificate.arn] == 10
+    assert report.at_risk() == [certificate.arn]
+    report = actions.check_health([certificate], now=certificate.not_after - timedelta(days=3))
+    assert report.critical == [certificate.arn]
+    report = actions.check_health([certificate], now=certificate.not_after)
+    assert report.expired == [certificate.arn]
+
+    pending_certificates = actions.query(identifier=certificate.identifier, state=certifier.States.PENDING)
+    actions.mark_for_deletion(pending_certificates)
+    renewed_certificate = actions.renew(certificate)
+    assert renewed_certificate.arn != certificate.arn
+    assert renewed_certificate.metadata[certifier.Tags.REPLACES] == certificate.arn
+    assert actions.renew(certificate) is None
+    assert actions.query(identifier=certificate.identifier, state=certifier.States.PENDING) == [renewed_certificate]
+
+
+def test_renew_skipped_while_pending(acm_client):
+    actions = certifier.actions()
+    available = actions.request_certificate("certificate2", ["a.example.com"])
+    actions.transition_to_available([available])
+    changed = actions.request_certificate("certificate2", ["a.example.com", "b.example.com"])
+    assert actions.renew(available) is None
+    actions = certifier.actions()
+    assert actions.query(identifier="certificate2", state=certifier.States.PENDING)[0].arn == changed.arn
+    assert actions.query(identifier="certificate2", state=certifier.States.AVAILABLE)[0].arn == available.arn
+
+
+def test_retry_failed_renewal(acm_client):
+    actions = certifier.actions()
+    available = actions.request_certificate("certificate2", ["a.example.com"])
+    actions.transition_to_available([available])
+    renewal = actions.renew(available)
+    retried = actions.retry(renewal)
+    assert retried.arn not in (available.arn, renewal.arn)
+    assert retried.metadata[certifier.Tags.REPLACES] == available.arn
+    # The next failure waits for its retry instead of falling back to the available certificate
+    assert actions.retry(retried) is None
+    actions = certifier.actions()
+    assert actions.query(identifier="certificate2", state=certifier.States.PENDING)[0].arn == retried.arn
+    assert actions.query(identifier="certificate2", state=certifier.States.AVAILABLE)[0].arn == available.arn
+    assert actions.query(identifier="certificate2", state=certifier.States.MARKED_FOR_DELETION)[0].arn == renewal.arn
+
+
+def test_scan(acm_client, monkeypatch):
+    actions = certifier.actions()
+    monkeypatch.setattr(actions, "max_workers", 2)
+    arns = sorted(summary["CertificateArn"] for summary in actions._list_certificates())
+    chunks = list(actions.scan(after=arns[0]))
+    assert [last_arn for _, last_arn in chunks] == [arns[2]]
+    assert [certificate.arn for certificate in chunks[0][0]] == arns[1:]
+    assert actions.inventory is None
+    pending = [
+        certificate for certificates, _ in actions.scan(state=certifier.States.PENDING) for certificate in certificates
+    ]
+    assert pending == actions.query(state=certifier.States.PENDING)
+
+
 def test_query_pending_state(acm_client):
     actions = certifier.actions()
     certificates = actions.query(identifier="certificate1", state=certifier.States.PENDING)
@@ -114,30 +304,99 @@ def test_mark_for_deletion(acm_client):
 def test_delete(acm_client, ssm_client):
     actions = certifier.actions()
     certificates = actions.query(identifier="certificate1")
-    success, failed = actions.delete((certificates[0],))
-    assert len(success) == 1
-    assert len(failed) == 0
+    summary = actions.delete((certificates[0],))
+    assert summary.deleted == [certificates[0].arn]
+    assert len(summary.failed) == 0
     assert len(actions.query(identifier="certificate1")) == 2
 
 
-def test_delete_non_existing(acm_client):
+def test_delete_ssm_parameter(acm_client, ssm_client):
+    actions = certifier.actions()
+    certificates = actions.query(identifier="certificate1")
+    ssm_client.put_parameter(Name="/certifier/certificate1", Value=certificates[1].arn, Type="String")
+    actions.delete((certificates[0],))
+    assert ssm_client.get_parameter(Name="/certifier/certificate1")["Parameter"]["Value"] == certificates[1].arn
+    actions.delete((certificates[1],))
+    assert ssm_client.get_parameters(Names=["/certifier/certificate1"])["Parameters"] == []
+
+
+def test_delete_non_existing(acm_client, ssm_client):
     actions = certifier.actions()
     certificates = actions.query(identifier="certificate1")
     deleted_certificate = certificates[0]
-    _, _ = actions.delete((deleted_certificate,))
+    actions.delete((deleted_certificate,))
     certificates = actions.query(identifier="certificate1")
-    success, failed = actions.delete((deleted_certificate,))
-    print(success)
-    assert len(success) == 1
-    assert len(failed) == 0
+    summary = actions.delete((deleted_certificate,))
+    assert summary.not_found == [deleted_certificate.arn]
+    assert len(summary.failed) == 0
     assert len(actions.query(identifier="certificate1")) == 2
 
 
 def test_delete_invalid_arn(acm_client):
     actions = certifier.actions()
-    success, failed = actions.delete(
+    summary = actions.delete(
         (None,),
     )
-    assert len(success) == 0
-    assert len(failed) == 1
+    assert len(summary.deleted) == 0
+    assert len(summary.failed) == 1
     assert len(actions.query(identifier="certificate1")) == 3
+
+
+def test_delete_in_use(acm_client, ssm_client, monkeypatch):
+    actions = certifier.actions(delete_retry_delay=60)
+    certificate = actions.query(identifier="certificate1")[0]
+
+    def delete_certificate(**kwargs):
+        raise actions.acm_client.exceptions.ResourceInUseException({"Error": {}}, "DeleteCertificate")
+
+    monkeypatch.setattr(actions.acm_client, "delete_certificate", delete_certificate)
+    summary = actions.delete((certificate,))
+    assert summary.in_use == [certificate.arn]
+    assert certificate.metadata[certifier.Tags.DELETE_ATTEMPTS] == "1"
+    assert summary == certifier.DeletionSummary(in_use=[certificate.arn])
+    actions.reset_inventory()
+    certificate = actions.query(identifier="certificate1")[0]
+    assert int(certificate.metadata[certifier.Tags.DELETE_AFTER]) > time.time() + 50
+    assert actions.delete((certificate,)).deferred == [certificate.arn]
+
+
+def test_list_certificates_unmanaged(acm_client):
+    for number in range(15):
+        acm_client.request_certificate(DomainName=f"{number}.paginated.example.com", ValidationMethod="DNS")
+    actions = certifier.actions()
+    assert len(list(actions._list_certificates())) == 18
+    assert len(actions.query()) == 3
+
+
+def test_list_certificates_max_items(acm_client):
+    actions = certifier.actions(max_items=2)
+    assert len(list(actions._list_certificates())) == 2
+
+
+def test_query_uses_inventory(acm_client):
+    actions = certifier.actions()
+    assert len(actions.query()) == 3
+    actions.acm_client = None  # Any call to ACM would fail from now on
+    assert len(actions.query(identifier="certificate1")) == 3
+    assert len(actions.query(state=certifier.States.PENDING)) == 1
+
+
+def test_inventory_follows_mutations(acm_client):
+    actions = certifier.actions()
+    certificate = actions.query(state=certifier.States.PENDING)[0]
+    actions.mark_for_deletion([certificate])
+    assert len(actions.query(state=certifier.States.PENDING)) == 0
+    assert len(actions.query(identifier="certificate1", state=certifier.States.MARKED_FOR_DELETION)) == 2
+    actions.reset_inventory()
+    assert len(actions.query(identifier="certificate1", state=certifier.States.MARKED_FOR_DELETION)) == 2
+
+
+def test_cache_across_invocations(acm_client):
+    actions = certifier.actions(cache_ttl=60)
+    certificate = actions.query(state=certifier.States.PENDING)[0]
+    actions.mark_for_deletion([certificate])
+    actions.reset_inventory()
+    # Tags must come from the cache, written through by mark_for_deletion
+    actions.acm_client.list_tags_for_certificate = None
+    assert len(actions.query(identifier="certificate1", state=certifier.States.MARKED_FOR_DELETION)) == 2
+    assert len(actions.query(state=certifier.States.PENDING)) == 0
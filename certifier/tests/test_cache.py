@@ -0,0 +1,46 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import time
+from certifier import cache
+
+
+def test_get_missing():
+    ttl_cache = cache.TTLCache(60)
+    assert ttl_cache.get("key") is cache.MISSING
+    ttl_cache.set("key", None)
+    assert ttl_cache.get("key") is None
+
+
+def test_expiration():
+    ttl_cache = cache.TTLCache(0.1)
+    ttl_cache.set("key", "value")
+    assert ttl_cache.get("key") == "value"
+    time.sleep(0.2)
+    assert ttl_cache.get("key") is cache.MISSING
+    assert len(ttl_cache) == 0
+
+
+def test_least_recently_used_eviction():
+    ttl_cache = cache.TTLCache(60, max_size=2)
+    ttl_cache.set("first", 1)
+    ttl_cache.set("second", 2)
+    ttl_cache.get("first")
+    ttl_cache.set("third", 3)
+    assert ttl_cache.get("second") is cache.MISSING
+    assert ttl_cache.get("first") == 1
+    assert ttl_cache.get("third") == 3
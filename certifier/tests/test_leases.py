@@ -0,0 +1,79 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import pytest  # type: ignore
+import boto3  # type: ignore
+from moto import mock_dynamodb  # type: ignore
+from certifier import certifier, leases
+
+
+@pytest.fixture(scope="function")
+def lease_table():
+    mock = mock_dynamodb()
+    mock.start()
+    leases.DynamoDBLeases(boto3.client("dynamodb"), "certifier-leases").create_table()
+    yield "certifier-leases"
+    mock.stop()
+
+
+def test_lease_is_exclusive(lease_table):
+    lease_store = leases.DynamoDBLeases(boto3.client("dynamodb"), lease_table)
+    token = lease_store.acquire("brand/a")
+    assert token is not None
+    assert lease_store.acquire("brand/a") is None
+    assert lease_store.acquire("brand/b") is not None
+    # Only the owner of a lease can release it
+    lease_store.release("brand/a", "someone else")
+    assert lease_store.acquire("brand/a") is None
+    lease_store.release("brand/a", token)
+    assert lease_store.acquire("brand/a") is not None
+
+
+def test_expired_lease_is_acquired(lease_table):
+    expired_leases = leases.DynamoDBLeases(boto3.client("dynamodb"), lease_table, ttl=-10)
+    expired_token = expired_leases.acquire("brand/a")
+    lease_store = leases.DynamoDBLeases(boto3.client("dynamodb"), lease_table)
+    token = lease_store.acquire("brand/a")
+    assert token is not None
+    # The expired owner no longer releases the lease
+    expired_leases.release("brand/a", expired_token)
+    assert lease_store.acquire("brand/a") is None
+
+
+def test_actions_lease(lease_table):
+    actions = certifier.actions(lease_table=lease_table)
+    other_actions = certifier.actions(lease_table=lease_table)
+    with actions.lease(["brand/a", "brand/b"]) as leased:
+        assert leased == {"brand/a", "brand/b"}
+        with other_actions.lease(["brand/b", "brand/c"]) as other_leased:
+            assert other_leased == {"brand/c"}
+    with other_actions.lease(["brand/a", "brand/b"]) as other_leased:
+        assert other_leased == {"brand/a", "brand/b"}
+    with certifier.actions().lease(["brand/a"]) as leased:
+        assert leased == {"brand/a"}
+
+
+def test_regional_actions_lease(lease_table):
+    # The lease table only exists in the region of the environment
+    actions = certifier.actions(region="eu-central-1", lease_table=lease_table)
+    other_actions = certifier.actions(region="eu-central-1", lease_table=lease_table)
+    with actions.lease(["brand/a"]) as leased:
+        assert leased == {"brand/a"}
+        with other_actions.lease(["brand/a"]) as other_leased:
+            assert other_leased == set()
+        with certifier.actions(lease_table=lease_table).lease(["brand/a"]) as other_leased:
+            assert other_leased == {"brand/a"}
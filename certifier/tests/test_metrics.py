@@ -0,0 +1,78 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import boto3
+import pytest
+from types import SimpleNamespace
+from botocore.config import Config  # type: ignore
+from botocore.exceptions import EndpointConnectionError  # type: ignore
+from botocore.model import ServiceId  # type: ignore
+from certifier import certifier, metrics
+
+
+def test_emit_embedded_metric_format(acm_client, capsys):
+    actions = certifier.actions()
+    actions.metrics.reset()
+    actions.request_certificate("certificate1", ("example.com",))
+    document = actions.metrics.emit({"Function": "test"})
+    assert json.loads(capsys.readouterr().out.strip().split("\n")[-1]) == document
+    directive = document["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Dimensions"] == [["Function"]]
+    assert {"Name": "acm.RequestCertificate.Latency", "Unit": "Milliseconds"} in directive["Metrics"]
+    assert document["Function"] == "test"
+    assert document["acm.RequestCertificate.Calls"] == 1
+    assert document["acm.ListTagsForCertificate.Calls"] == 3
+    assert len(document["acm.ListTagsForCertificate.Latency"]) == 3
+    assert document["CertificatesRequested"] == 1
+    assert document["CertificatesMarkedForDeletion"] == 1
+
+
+def test_throttles_counted():
+    collected_metrics = metrics.Metrics()
+    operation = SimpleNamespace(name="PutParameter", service_model=SimpleNamespace(service_id=ServiceId("ssm")))
+    collected_metrics._needs_retry(operation, response=(None, {"Error": {"Code": "TooManyUpdates"}}))
+    collected_metrics._needs_retry(operation, response=(None, {}))
+    assert collected_metrics.counters == {"ssm.PutParameter.Throttles": 1}
+
+
+def test_latencies_summarized():
+    collected_metrics = metrics.Metrics()
+    for latency in range(1000):
+        collected_metrics.observe("Latency", latency)
+    values = collected_metrics.emit()["Latency"]
+    assert len(values) == metrics.MAX_VALUES
+    assert values[0] == 0 and values[-1] == 999
+
+
+def test_connection_errors_propagate():
+    collected_metrics = metrics.Metrics()
+    client = collected_metrics.install(
+        boto3.client(
+            "acm",
+            region_name="us-east-1",
+            endpoint_url="http://127.0.0.1:1",
+            aws_access_key_id="testing",
+            aws_secret_access_key="testing",
+            config=Config(retries={"total_max_attempts": 1}, connect_timeout=1),
+        )
+    )
+    with pytest.raises(EndpointConnectionError):
+        client.list_certificates()
+    assert collected_metrics.counters["acm.ListCertificates.Calls"] == 1
+    assert collected_metrics.counters["acm.ListCertificates.Errors"] == 1
+    assert len(collected_metrics.latencies["acm.ListCertificates.Latency"]) == 1
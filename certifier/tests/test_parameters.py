@@ -0,0 +1,49 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+from certifier import parameters
+
+
+def test_queued_puts(ssm_client):
+    parameter_store = parameters.ParameterStore(ssm_client)
+    parameter_store.put("brand/a", "arn:1")
+    parameter_store.put("brand/a", "arn:2")
+    assert parameter_store.get(["brand/a", "brand/b"]) == {"brand/a": "arn:2"}
+    assert ssm_client.get_parameters(Names=["/certifier/brand/a"])["Parameters"] == []
+    parameter_store.flush()
+    assert ssm_client.get_parameter(Name="/certifier/brand/a")["Parameter"]["Value"] == "arn:2"
+
+
+def test_get_in_batches(ssm_client):
+    parameter_store = parameters.ParameterStore(ssm_client)
+    for number in range(25):
+        parameter_store.put(f"brand/{number}", f"arn:{number}")
+    parameter_store.flush()
+    values = parameter_store.get(f"brand/{number}" for number in range(30))
+    assert values == {f"brand/{number}": f"arn:{number}" for number in range(25)}
+
+
+def test_delete_if_matches(ssm_client):
+    parameter_store = parameters.ParameterStore(ssm_client)
+    parameter_store.put("brand/a", "arn:1")
+    parameter_store.put("brand/b", "arn:2")
+    parameter_store.flush()
+    deleted = parameter_store.delete_if_matches(
+        {"brand/a": {"arn:1", "arn:3"}, "brand/b": {"arn:3"}, "brand/c": {"arn:4"}}
+    )
+    assert deleted == ["brand/a"]
+    assert parameter_store.get(["brand/a", "brand/b", "brand/c"]) == {"brand/b": "arn:2"}
@@ -0,0 +1,36 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import marshal
+from concurrent.futures import ThreadPoolExecutor
+from certifier import profiling
+
+
+def allocate(size):
+    return [bytearray(1024) for _ in range(size)]
+
+
+def test_profile_threads():
+    with profiling.Profile() as profile:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            allocated = list(executor.map(allocate, [100, 200]))
+    assert len(allocated) == 2
+    functions = [function for _, _, function in profile.stats().stats]
+    assert functions.count("allocate") == 1
+    assert profile.stats().stats == marshal.loads(profile.dump())
+    report = profile.report()
+    assert "allocate" in report and "Top 30 allocation sites" in report
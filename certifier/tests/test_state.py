@@ -0,0 +1,84 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import pytest  # type: ignore
+import boto3  # type: ignore
+from moto import mock_dynamodb  # type: ignore
+from certifier import certifier, state
+
+
+@pytest.fixture(scope="function")
+def state_store():
+    mock = mock_dynamodb()
+    mock.start()
+    state_store = state.DynamoDBStateStore(boto3.client("dynamodb"), "certifier")
+    state_store.create_table()
+    yield state_store
+    mock.stop()
+
+
+def state_actions(monkeypatch):
+    actions = certifier.actions(state_table="certifier")
+
+    def list_certificates():
+        raise AssertionError("certificates should not be listed in ACM")
+
+    monkeypatch.setattr(actions, "_list_certificates", list_certificates)
+    return actions
+
+
+def test_state_store_query(state_store):
+    state_store.put("arn:1", "brand/a", "certifier_pending", {"certifier_id": "brand/a"})
+    state_store.put("arn:2", "brand/a", "certifier_available", {"certifier_id": "brand/a"})
+    state_store.put("arn:3", "brand/b", "certifier_pending", {"certifier_id": "brand/b"})
+    assert sorted(state_store.query()) == ["arn:1", "arn:2", "arn:3"]
+    assert sorted(state_store.query(state="certifier_pending")) == ["arn:1", "arn:3"]
+    assert sorted(state_store.query(identifier="brand/a")) == ["arn:1", "arn:2"]
+    assert state_store.query(identifier="brand/a", state="certifier_available") == {
+        "arn:2": {"certifier_id": "brand/a"}
+    }
+    state_store.delete("arn:2")
+    assert sorted(state_store.query(identifier="brand/a")) == ["arn:1"]
+
+
+def test_rebuild_state_store(acm_client, state_store, monkeypatch):
+    state_store.put("arn:gone", "certificate1", "certifier_pending", {"certifier_id": "certificate1"})
+    assert certifier.actions(state_table="certifier").rebuild_state_store() == ["arn:gone"]
+    actions = state_actions(monkeypatch)
+    assert len(actions.query()) == 3
+    pending_certificates = actions.query(identifier="certificate1", state=certifier.States.PENDING)
+    assert len(pending_certificates) == 1
+    assert pending_certificates[0] == certifier.actions().query(state=certifier.States.PENDING)[0]
+
+
+def test_state_store_follows_mutations(acm_client, ssm_client, state_store, monkeypatch):
+    certifier.actions(state_table="certifier").rebuild_state_store()
+    actions = state_actions(monkeypatch)
+    certificate = actions.request_certificate("certificate2", ["a.example.com"])
+    assert actions.query(identifier="certificate2", state=certifier.States.PENDING) == [certificate]
+    actions.mark_for_deletion([certificate])
+    assert actions.query(identifier="certificate2", state=certifier.States.PENDING) == []
+    marked_certificates = actions.query(state=certifier.States.MARKED_FOR_DELETION)
+    assert certificate.arn in [marked_certificate.arn for marked_certificate in marked_certificates]
+    actions.delete(marked_certificates)
+
+    actions = state_actions(monkeypatch)
+    assert actions.query(state=certifier.States.MARKED_FOR_DELETION) == []
+    assert sorted(certificate.state.value for certificate in actions.query()) == [
+        "certifier_available",
+        "certifier_pending",
+    ]
@@ -0,0 +1,58 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import time
+from types import SimpleNamespace
+from certifier import certifier, throttling
+
+
+def test_token_bucket_rate():
+    bucket = throttling.TokenBucket(10)
+    for _ in range(10):
+        bucket.acquire()
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.4
+
+
+def test_token_bucket_adapts_to_throttling():
+    bucket = throttling.TokenBucket(8)
+    bucket.throttled()
+    bucket.throttled()
+    assert bucket.current_rate == 2
+    for _ in range(100):
+        bucket.succeeded()
+    assert bucket.current_rate == 8
+
+
+def test_rate_limiter_counts_throttling():
+    rate_limiter = throttling.RateLimiter({"DescribeCertificate": 4})
+    operation = SimpleNamespace(name="DescribeCertificate")
+    rate_limiter._before_send(event_name="before-send.acm.DescribeCertificate")
+    rate_limiter._needs_retry(operation, response=(None, {"Error": {"Code": "ThrottlingException"}}))
+    rate_limiter._before_send(event_name="before-send.acm.DescribeCertificate")
+    rate_limiter._needs_retry(operation, response=(None, {}))
+    assert rate_limiter.stats["DescribeCertificate"] == {"requests": 2, "throttled": 1}
+    assert rate_limiter._buckets["DescribeCertificate"].current_rate == 2.4
+
+
+def test_rate_limiter_installed(acm_client):
+    actions = certifier.actions()
+    actions.query(with_acm_state=True)
+    assert actions.rate_limiter.stats["ListCertificates"]["requests"] == 1
+    assert actions.rate_limiter.stats["DescribeCertificate"] == {"requests": 3, "throttled": 0}
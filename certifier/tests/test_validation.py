@@ -0,0 +1,83 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import pytest  # type: ignore
+import boto3  # type: ignore
+from moto import mock_route53  # type: ignore
+from certifier import certifier, validation
+
+
+@pytest.fixture(scope="function")
+def route53_client():
+    mock = mock_route53()
+    mock.start()
+    route53_client = boto3.client("route53")
+    route53_client.create_hosted_zone(Name="example.com", CallerReference="example.com")
+    route53_client.create_hosted_zone(Name="sub.example.com", CallerReference="sub.example.com")
+    route53_client.create_hosted_zone(
+        Name="internal.example.com",
+        CallerReference="internal.example.com",
+        HostedZoneConfig={"Comment": "internal", "PrivateZone": True},
+        VPC={"VPCRegion": "us-east-1", "VPCId": "vpc-12345678"},
+    )
+    yield route53_client
+    mock.stop()
+
+
+def zone_id(route53_client, name):
+    return next(zone["Id"] for zone in route53_client.list_hosted_zones()["HostedZones"] if zone["Name"] == name)
+
+
+def test_dedupe_records():
+    records = [("_a.Example.com", "_x.acm."), ("_a.example.com.", "_x.acm."), ("_a.example.com", "_y.acm.")]
+    assert validation.dedupe_records(records) == [("_a.example.com.", "_x.acm.")]
+
+
+def test_hosted_zone_for(route53_client):
+    exporter = validation.ValidationRecordExporter(route53_client)
+    assert exporter.hosted_zone_for("_a.www.example.com.") == zone_id(route53_client, "example.com.")
+    assert exporter.hosted_zone_for("_a.sub.example.com.") == zone_id(route53_client, "sub.example.com.")
+    assert exporter.hosted_zone_for("_a.internal.example.com.") == zone_id(route53_client, "example.com.")
+    assert exporter.hosted_zone_for("_a.example.org.") is None
+
+
+def test_change_batches_limits(route53_client):
+    exporter = validation.ValidationRecordExporter(route53_client)
+    records = [(f"_{number}.example.com", f"_{number}.acm-validations.aws.") for number in range(1200)]
+    batches, unmatched = exporter.change_batches(records + [("_a.example.org", "_a.acm-validations.aws.")])
+    assert unmatched == ["_a.example.org."]
+    assert [len(batch["Changes"]) for batch in batches[zone_id(route53_client, "example.com.")]] == [500, 500, 200]
+
+    long_records = [(f"_{number}.example.com", "_" + "x" * 999) for number in range(20)]
+    batches, _ = exporter.change_batches(long_records)
+    assert [len(batch["Changes"]) for batch in batches[zone_id(route53_client, "example.com.")]] == [16, 4]
+
+
+def test_export_pending_records(acm_client, route53_client):
+    actions = certifier.actions()
+    actions.route53_client = route53_client
+    actions.request_certificate("certificate2", ["0.example.com", "1.example.com"])
+    records = actions.validation_records()
+    # Both pending certificates share their domains with the pending certificate of the fixture
+    assert len(records) == 5
+    exporter = validation.ValidationRecordExporter(route53_client)
+    batches, unmatched = exporter.change_batches(records)
+    assert unmatched == [] and len(exporter.apply(batches)) == 1
+    record_sets = route53_client.list_resource_record_sets(HostedZoneId=zone_id(route53_client, "example.com."))
+    assert {
+        record_set["Name"] for record_set in record_sets["ResourceRecordSets"] if record_set["Type"] == "CNAME"
+    } == {name for name, _ in records}
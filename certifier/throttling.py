@@ -0,0 +1,159 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+from typing import Dict, Optional
+
+# Requests per second allowed for each API operation, based on the default AWS quotas.
+# Operations not listed here are not rate limited.
+DEFAULT_RATE_LIMITS: Dict[str, float] = {
+    # ACM
+    "AddTagsToCertificate": 5,
+    "DeleteCertificate": 10,
+    "DescribeCertificate": 10,
+    "ListCertificates": 8,
+    "ListTagsForCertificate": 10,
+    "RemoveTagsFromCertificate": 5,
+    "RequestCertificate": 5,
+    # SSM
+    "DeleteParameter": 5,
+    "DeleteParameters": 5,
+    "GetParameter": 40,
+    "GetParameters": 40,
+    "GetParametersByPath": 40,
+    "PutParameter": 3,
+    # Route 53
+    "ChangeResourceRecordSets": 5,
+    "ListHostedZones": 5,
+    # S3
+    "GetObject": 500,
+    "ListObjectsV2": 500,
+    "PutObject": 300,
+}
+
+THROTTLING_ERROR_CODES = (
+    "RequestLimitExceeded",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "TooManyRequestsException",
+    "TooManyUpdates",
+)
+
+
+class TokenBucket:
+    """
+    Token bucket allowing up to 'rate' requests per second, with bursts of up to 'rate' requests.
+    The rate is adapted to throttling: it is halved whenever a request is throttled and recovers
+    by a tenth of the configured rate for every successful request (additive increase, multiplicative decrease).
+    """
+
+    def __init__(self, rate: float, min_rate: float = 0.5):
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.current_rate = rate
+        self._tokens = max(1.0, rate)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(max(1.0, self.current_rate), self._tokens + (now - self._updated_at) * self.current_rate)
+        self._updated_at = now
+
+    def acquire(self) -> None:
+        """
+        Blocks until a token is available and consumes it
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.current_rate
+            time.sleep(wait)
+
+    def throttled(self) -> None:
+        with self._lock:
+            self.current_rate = max(self.min_rate, self.current_rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self.current_rate = min(self.rate, self.current_rate + self.rate / 10)
+
+
+class RateLimiter:
+    """
+    Paces the requests of every boto client it is installed on, with one TokenBucket per API operation.
+    Buckets are shared by all clients, so concurrent requests are limited together.
+    The stats attribute counts, per operation, how many requests were sent and how many of them were throttled.
+    """
+
+    def __init__(self, rate_limits: Optional[Dict[str, float]] = None):
+        self.rate_limits: Dict[str, float] = {**DEFAULT_RATE_LIMITS, **(rate_limits or {})}
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def install(self, client):
+        """
+        Registers the rate limiter on the client's events and returns the client
+        """
+        client.meta.events.register("before-send", self._before_send)
+        client.meta.events.register("needs-retry", self._needs_retry)
+        return client
+
+    def _bucket(self, operation_name: str) -> Optional[TokenBucket]:
+        with self._lock:
+            if operation_name not in self._buckets and self.rate_limits.get(operation_name):
+                self._buckets[operation_name] = TokenBucket(self.rate_limits[operation_name])
+            return self._buckets.get(operation_name)
+
+    def _count(self, operation_name: str, counter: str) -> None:
+        with self._lock:
+            operation_stats = self.stats.setdefault(operation_name, {"requests": 0, "throttled": 0})
+            operation_stats[counter] += 1
+
+    def _before_send(self, event_name: str, **kwargs) -> None:
+        """
+        Called before every attempt of a request, including retries
+        """
+        operation_name = event_name.split(".")[-1]
+        self._count(operation_name, "requests")
+        bucket = self._bucket(operation_name)
+        if bucket is not None:
+            bucket.acquire()
+
+    def _needs_retry(self, operation, response=None, **kwargs) -> None:
+        """
+        Called after every attempt of a request, adapts the rate of the operation to throttling.
+        Always returns None so botocore's own retry handler decides whether to retry.
+        """
+        if response is None:
+            return
+        error_code = response[1].get("Error", {}).get("Code")
+        bucket = self._bucket(operation.name)
+        if error_code in THROTTLING_ERROR_CODES:
+            self._count(operation.name, "throttled")
+            if bucket is not None:
+                bucket.throttled()
+        elif bucket is not None and error_code is None:
+            bucket.succeeded()
@@ -0,0 +1,132 @@
+# serverless-acm-manager, A serverless application to manage your AWS ACM certificates for you.
+# Copyright (C) 2020  Marco Aurelio Alano Godinho
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Most changes allowed in a single ChangeResourceRecordSets request, in which an UPSERT counts as two changes
+MAX_CHANGES = 1000
+# Most characters allowed in the values of a single ChangeResourceRecordSets request, UPSERT values count twice
+MAX_VALUE_CHARACTERS = 32000
+
+
+def normalize_name(name: str) -> str:
+    """
+    Returns a DNS name in lower case with a trailing dot, as Route 53 returns them
+    """
+    return name.lower().rstrip(".") + "."
+
+
+def dedupe_records(records: Iterable[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """
+    Returns the unique (name, value) CNAME records, in the order they first appear, with normalized names.
+    As a name can only have one CNAME, records for a name that already has a different value are skipped.
+    """
+    values: Dict[str, str] = {}
+    for name, value in records:
+        name = normalize_name(name)
+        if values.setdefault(name, value) != value:
+            print(f"Ignoring conflicting validation record {name} CNAME {value}, already exporting {values[name]}")
+    return list(values.items())
+
+
+class ValidationRecordExporter:
+    """
+    Exports the CNAME records ACM validates certificates with to the public hosted zones in Route 53.
+    Each record goes to the hosted zone with the longest name the record name is part of,
+    changes being grouped in as few ChangeBatch documents per hosted zone as the API limits allow.
+    """
+
+    def __init__(self, route53_client, ttl: int = 300):
+        self.route53_client = route53_client
+        self.ttl = ttl
+        self._hosted_zones: Optional[Dict[str, str]] = None
+
+    def hosted_zones(self) -> Dict[str, str]:
+        """
+        Returns the IDs of the public hosted zones by zone name, listing them on the first call
+        """
+        if self._hosted_zones is None:
+            self._hosted_zones = {
+                normalize_name(zone["Name"]): zone["Id"]
+                for page in self.route53_client.get_paginator("list_hosted_zones").paginate()
+                for zone in page["HostedZones"]
+                if not zone.get("Config", {}).get("PrivateZone", False)
+            }
+        return self._hosted_zones
+
+    def hosted_zone_for(self, name: str) -> Optional[str]:
+        """
+        Returns the ID of the hosted zone with the longest name that the record name is part of, or None
+        """
+        labels = normalize_name(name).split(".")
+        for start in range(len(labels) - 1):
+            zone_id = self.hosted_zones().get(".".join(labels[start:]))
+            if zone_id is not None:
+                return zone_id
+        return None
+
+    def _change(self, name: str, value: str) -> Dict:
+        return {
+            "Action": "UPSERT",
+            "ResourceRecordSet": {
+                "Name": name,
+                "Type": "CNAME",
+                "TTL": self.ttl,
+                "ResourceRecords": [{"Value": value}],
+            },
+        }
+
+    def change_batches(self, records: Iterable[Tuple[str, str]]) -> Tuple[Dict[str, List[Dict]], List[str]]:
+        """
+        Returns a tuple with the ChangeBatch documents upserting the deduplicated records by hosted zone ID,
+        and the names of the records for which no hosted zone was found
+        """
+        changes: Dict[str, List[Dict]] = {}
+        unmatched: List[str] = []
+        for name, value in dedupe_records(records):
+            zone_id = self.hosted_zone_for(name)
+            if zone_id is None:
+                unmatched.append(name)
+                continue
+            changes.setdefault(zone_id, []).append(self._change(name, value))
+
+        batches: Dict[str, List[Dict]] = {}
+        for zone_id, zone_changes in changes.items():
+            batches[zone_id] = []
+            batch: List[Dict] = []
+            value_characters = 0
+            for change in zone_changes:
+                characters = 2 * len(change["ResourceRecordSet"]["ResourceRecords"][0]["Value"])
+                if batch and (
+                    2 * (len(batch) + 1) > MAX_CHANGES or value_characters + characters > MAX_VALUE_CHARACTERS
+                ):
+                    batches[zone_id].append({"Changes": batch})
+                    batch, value_characters = [], 0
+                batch.append(change)
+                value_characters += characters
+            batches[zone_id].append({"Changes": batch})
+        return batches, unmatched
+
+    def apply(self, batches: Dict[str, List[Dict]]) -> List[str]:
+        """
+        Sends the change batches to Route 53, returning the ID of each change
+        """
+        return [
+            self.route53_client.change_resource_record_sets(HostedZoneId=zone_id, ChangeBatch=batch)["ChangeInfo"]["Id"]
+            for zone_id, zone_batches in batches.items()
+            for batch in zone_batches
+        ]
@@ -17,7 +17,7 @@
 
 import pathlib
 import pytest  # type: ignore
-from moto import mock_s3  # type: ignore
+from moto import mock_acm, mock_s3, mock_sqs, mock_ssm  # type: ignore
 import boto3  # type: ignore
 
 
@@ -30,6 +30,33 @@ def s3_client():
     mock.stop()
 
 
+@pytest.fixture(scope="function")
+def acm_client():
+    mock = mock_acm()
+    mock.start()
+    acm_client = boto3.client("acm")
+    yield acm_client
+    mock.stop()
+
+
+@pytest.fixture(scope="function")
+def ssm_client():
+    mock = mock_ssm()
+    mock.start()
+    ssm_client = boto3.client("ssm")
+    yield ssm_client
+    mock.stop()
+
+
+@pytest.fixture(scope="function")
+def sqs_client():
+    mock = mock_sqs()
+    mock.start()
+    sqs_client = boto3.client("sqs")
+    yield sqs_client
+    mock.stop()
+
+
 def pytest_runtest_setup(item):
     """
     Make the variable "test_files" available for the current test item.
@@ -15,14 +15,186 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import dataclasses
+import functools
+import json
 import os
+import random
 import re
-from typing import List, Generator, Tuple, Dict
-import boto3  # type: ignore
-from certifier import certifier
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, List, Generator, Optional, Tuple, Dict, Callable
+from certifier import certifier, clients, leases, profiling, validation
 
-actions = certifier.actions()
-s3_client = boto3.client("s3")
+ACTIONS_OPTIONS = {
+    # Opt-in cache kept across invocations of a warm container, see certifier.actions
+    "cache_ttl": float(os.environ.get("CERTIFIER_CACHE_TTL", 0)),
+    "cache_size": int(os.environ.get("CERTIFIER_CACHE_SIZE", 4096)),
+    "rate_limits": json.loads(os.environ.get("CERTIFIER_RATE_LIMITS", "{}")),
+    "state_table": os.environ.get("CERTIFIER_STATE_TABLE") or None,
+    # Opt-in leases on identifiers, so concurrent invocations never change the certificates of the same file
+    "lease_table": os.environ.get("CERTIFIER_LEASE_TABLE") or None,
+    "lease_ttl": float(os.environ.get("CERTIFIER_LEASE_TTL", 300)),
+    # Backoff of the retries of certificates that failed validation, see certifier.actions.retry
+    "retry_delay": float(os.environ.get("CERTIFIER_RETRY_DELAY", 3600)),
+    "max_retry_delay": float(os.environ.get("CERTIFIER_MAX_RETRY_DELAY", 24 * 3600)),
+    "max_retries": int(os.environ.get("CERTIFIER_MAX_RETRIES", 8)),
+}
+# Actions for the region of the lambda
+actions = certifier.actions(**ACTIONS_OPTIONS)
+# Actions for the other regions certificates are managed in, from the comma-separated list in CERTIFIER_REGIONS
+regional_actions: Dict[str, certifier.actions] = {
+    region: certifier.actions(region=region, **ACTIONS_OPTIONS)
+    for region in (region.strip() for region in os.environ.get("CERTIFIER_REGIONS", "").split(","))
+    if region
+}
+# Created on first use by get_s3_client(), as only manage_certificates needs it
+s3_client = None
+s3_client_lock = threading.Lock()
+# Domains files with more domains than this are split in multiple certificates, as per ACM's quota on domains per certificate
+MAX_DOMAINS_PER_CERTIFICATE = int(os.environ.get("CERTIFIER_MAX_DOMAINS_PER_CERTIFICATE", 10))
+# Separates the identifier of a file from the position of a shard. Identifiers are stripped of everything
+# from the first dot of the file name, so no file can have the identifier of another file's shard.
+SHARD_SEPARATOR = "."
+SHARD_PATTERN = re.compile(r"(.+)" + re.escape(SHARD_SEPARATOR) + r"[0-9]+")
+# S3 object keys must be valid parameter names in Parameter Store
+S3_KEY_PATTERN = re.compile(r"([A-Za-z0-9]|-|_|\.|/)+")
+# Bucket with the domains files, listed by reconcile_certificates
+CERTIFICATES_BUCKET = os.environ.get("CERTIFIER_BUCKET")
+# When enabled, reconcile_certificates only reports the changes it would make
+RECONCILE_DRY_RUN = os.environ.get("CERTIFIER_RECONCILE_DRY_RUN", "false").lower() == "true"
+# When enabled, export_validation_records upserts the validation records in Route 53 instead of only reporting them
+APPLY_VALIDATION_RECORDS = os.environ.get("CERTIFIER_APPLY_VALIDATION_RECORDS", "false").lower() == "true"
+# Seconds manage_certificates waits for the lease of an identifier held by another invocation before failing the change
+LEASE_WAIT = float(os.environ.get("CERTIFIER_LEASE_WAIT", 30))
+# Available certificates expiring in less than this many days are reported by scan_certificates,
+# as critical when less than EXPIRY_CRITICAL_DAYS are left
+EXPIRY_WARNING_DAYS = int(os.environ.get("CERTIFIER_EXPIRY_WARNING_DAYS", 30))
+EXPIRY_CRITICAL_DAYS = int(os.environ.get("CERTIFIER_EXPIRY_CRITICAL_DAYS", 7))
+# When enabled, scan_certificates requests the certificates at risk of expiring again
+RENEW_AT_RISK = os.environ.get("CERTIFIER_RENEW_AT_RISK", "false").lower() == "true"
+# When enabled, the given percentage of invocations is profiled and the profiles are uploaded under PROFILES_PREFIX
+PROFILE = os.environ.get("CERTIFIER_PROFILE", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.environ.get("CERTIFIER_PROFILE_SAMPLE_RATE", 100))
+# Prefix of the profiles in the certificates bucket, objects under it are not domains files
+PROFILES_PREFIX = "_profiles/"
+# Sweeps stop once less than this many milliseconds are left before the lambda times out
+SWEEP_TIME_MARGIN = int(os.environ.get("CERTIFIER_SWEEP_TIME_MARGIN", 15000))
+
+
+def get_s3_client():
+    """
+    Returns the S3 client, creating it on first use
+    """
+    global s3_client
+    with s3_client_lock:
+        if s3_client is None:
+            s3_client = actions.install(clients.create_client("s3"))
+        return s3_client
+
+
+def invocation(handler):
+    """
+    Decorator for lambda handlers. The certificate inventory is kept on the module level actions objects,
+    which outlive a single invocation in warm containers, so it is discarded before each invocation.
+    Writes to Parameter Store queued during the invocation are sent once the handler returns,
+    after which the metrics collected during the invocation are logged in CloudWatch Embedded Metric Format,
+    with the region as an additional dimension for regions other than the one of the lambda.
+    When CERTIFIER_PROFILE is enabled, a sample of invocations is profiled, see upload_profile().
+    S3 events delivered through SQS are unwrapped once, handlers receiving them as an SQSBatch.
+    """
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if is_sqs_event(event):
+            event = SQSBatch(*get_s3_event_from_sqs_event(event))
+        # Uploading a profile notifies manage_certificates, so invocations for profiles are never profiled
+        if PROFILE and not is_profiles_event(event) and random.uniform(0, 100) < PROFILE_SAMPLE_RATE:
+            invocation_profile = profiling.Profile()
+            try:
+                with invocation_profile:
+                    return invoke(event, context)
+            finally:
+                upload_profile(handler.__name__, context, invocation_profile)
+        return invoke(event, context)
+
+    def invoke(event, context):
+        all_actions = get_regional_actions()
+        for region_actions in all_actions.values():
+            region_actions.reset_inventory()
+            region_actions.metrics.reset()
+        started = time.perf_counter()
+        try:
+            return handler(event, context)
+        except Exception:
+            actions.metrics.increment("InvocationsFailed")
+            raise
+        finally:
+            try:
+                for region_actions in all_actions.values():
+                    region_actions.flush()
+            finally:
+                actions.metrics.observe("Duration", (time.perf_counter() - started) * 1000)
+                for region, region_actions in all_actions.items():
+                    dimensions = {"Function": handler.__name__}
+                    if region_actions is not actions:
+                        dimensions["Region"] = region
+                    region_actions.metrics.emit(dimensions)
+
+    return wrapper
+
+
+def upload_profile(name: str, context, invocation_profile: profiling.Profile) -> None:
+    """
+    Uploads the profile of an invocation of a handler to the certificates bucket, as a cProfile output file (.prof)
+    and a report of the top functions and allocation sites (.txt) under PROFILES_PREFIX.
+    The report is logged instead when no bucket is configured, failing to upload never fails the invocation.
+    """
+    invocation_id = getattr(context, "aws_request_id", None) or uuid.uuid4().hex
+    key = f"{PROFILES_PREFIX}{name}/{time.strftime('%Y-%m-%dT%H-%M-%S', time.gmtime())}-{invocation_id}"
+    report = invocation_profile.report()
+    if not CERTIFICATES_BUCKET:
+        print(f"Profile of {name}:\n{report}")
+        return
+    try:
+        get_s3_client().put_object(Bucket=CERTIFICATES_BUCKET, Key=f"{key}.prof", Body=invocation_profile.dump())
+        get_s3_client().put_object(Bucket=CERTIFICATES_BUCKET, Key=f"{key}.txt", Body=report.encode("utf-8"))
+        print(f"Uploaded profile of {name} to s3://{CERTIFICATES_BUCKET}/{key}.prof")
+    except Exception as e:
+        print(f"Failed to upload profile of {name} with the following reason: {e}")
+
+
+def is_profiles_event(event) -> bool:
+    """
+    Returns whether an event is an S3 event, delivered directly or through SQS (as an SQSBatch),
+    that only refers to objects under PROFILES_PREFIX
+    """
+    if isinstance(event, SQSBatch):
+        if event.malformed_messages:
+            return False
+        event = event.s3_event
+    records = event.get("Records") if isinstance(event, dict) else None
+    if not records:
+        return False
+    return all(record.get("s3", {}).get("object", {}).get("key", "").startswith(PROFILES_PREFIX) for record in records)
+
+
+def get_identifier_from_s3_key(bucket: str, key: str) -> Tuple[str, str]:
+    """
+    Returns a tuple with the identifier of the certificate for an S3 object, which is its key stripped of file extensions
+    (up to the first dot), and the reason why the object cannot be used for a certificate, which is empty if it can.
+    """
+    failed_reason = ""
+    if key[-1] == "/":
+        failed_reason += f"Ignoring S3 folder object: 's3://{bucket}/{key}'. "
+
+    if not S3_KEY_PATTERN.fullmatch(key):
+        failed_reason += f"The S3 object key '{key}' is not a valid parameter name for AWS Parameter Store (it does not match '{S3_KEY_PATTERN.pattern}'). "
+
+    split_key = key.split("/")
+    return "/".join(split_key[:-1] + [split_key[-1].split(".")[0]]), failed_reason
 
 
 def get_certificates_from_s3_event(
@@ -36,6 +208,7 @@ def get_certificates_from_s3_event(
     The third element of tuples in the list of failed items is the reason for the failure instead of the object key stripped of extensions.
     The following validation is performed:
     * Make sure the S3 key only contains letters, numbers and the characters .-_ to make sure it can be used as the name of a parameter in Parameter Store.
+    Objects under PROFILES_PREFIX are profiles uploaded by the handlers (see upload_profile), they are skipped.
     Example of a create list:
     [("my_bucket", "key/to.my/object.first.txt", "key/to/object")]
     Example of a failure list:
@@ -44,7 +217,6 @@ def get_certificates_from_s3_event(
     if "Records" not in event:
         raise KeyError("'Records' key not found in event object")
 
-    name_pattern = re.compile(r"([A-Za-z0-9]|-|_|\.|/)+")
     delete_certificates: List[Tuple[str, str, str]] = []
     create_certificates: List[Tuple[str, str, str]] = []
     failed_certificates: List[Tuple[str, str, str]] = []
@@ -56,20 +228,15 @@ def get_certificates_from_s3_event(
             s3_data["object"]["key"],
         )
 
-        failed_reason = ""
-        if certificate_file_data[1][-1] == "/":
-            failed_reason += f"Ignoring S3 folder object: 's3://{'/'.join(certificate_file_data)}'. "
-
-        if not name_pattern.fullmatch(certificate_file_data[1]):
-            failed_reason += f"The S3 object key '{certificate_file_data[1]}' is not a valid parameter name for AWS Parameter Store (it does not match '{name_pattern.pattern}'). "
+        if certificate_file_data[1].startswith(PROFILES_PREFIX):
+            print(f"Ignoring profile object: 's3://{'/'.join(certificate_file_data)}'")
+            continue
 
+        key_stripped_extension, failed_reason = get_identifier_from_s3_key(*certificate_file_data)
         if failed_reason:
             failed_certificates.append(certificate_file_data + (failed_reason,))
             continue
 
-        split_key = certificate_file_data[1].split("/")
-        key_stripped_extension = "/".join(split_key[:-1] + [split_key[-1].split(".")[0]])
-
         if record["eventName"].startswith("ObjectCreated"):
             create_certificates.append(certificate_file_data + (key_stripped_extension,))
         if record["eventName"].startswith("ObjectRemoved"):
@@ -78,53 +245,759 @@ def get_certificates_from_s3_event(
     return delete_certificates, create_certificates, failed_certificates
 
 
+def plan_certificates_from_s3_event(
+    event: Dict,
+) -> Tuple[List[Tuple[str, str, str]], List[Tuple[str, str, str]], List[Tuple[str, str, str]]]:
+    """
+    Same as get_certificates_from_s3_event, except that records are collapsed so that each identifier
+    appears at most once in the delete and create lists, with the final action intended for it:
+    * Events for the same object are ordered by their S3 sequencer, only the latest one is kept.
+    * When objects with different extensions map to the same identifier, a created object takes precedence
+      over a removed one, as the identifier is still backed by a file. Otherwise the last record wins.
+    """
+    if "Records" not in event:
+        raise KeyError("'Records' key not found in event object")
+
+    failed_certificates: List[Tuple[str, str, str]] = []
+    # (bucket, key) -> ((sequencer, position), action, certificate)
+    latest_by_object: Dict[Tuple[str, str], Tuple[Tuple[int, int], str, Tuple[str, str, str]]] = {}
+    for position, record in enumerate(event["Records"]):
+        delete, create, failed = get_certificates_from_s3_event({"Records": [record]})
+        failed_certificates += failed
+        order = (int(record["s3"]["object"].get("sequencer", "0"), 16), position)
+        for action, certificate in [("delete", item) for item in delete] + [("create", item) for item in create]:
+            latest = latest_by_object.get(certificate[:2])
+            if latest is None or latest[0] < order:
+                latest_by_object[certificate[:2]] = (order, action, certificate)
+
+    planned: Dict[str, Tuple[str, Tuple[str, str, str]]] = {}
+    for _, action, certificate in sorted(latest_by_object.values(), key=lambda latest: latest[0][1]):
+        identifier = certificate[2]
+        if identifier not in planned or action == "create" or planned[identifier][0] == "delete":
+            planned[identifier] = (action, certificate)
+
+    delete_certificates = [certificate for action, certificate in planned.values() if action == "delete"]
+    create_certificates = [certificate for action, certificate in planned.values() if action == "create"]
+    return delete_certificates, create_certificates, failed_certificates
+
+
+@dataclasses.dataclass
+class SQSBatch:
+    """
+    The S3 events delivered as the messages of an SQS event, as returned by get_s3_event_from_sqs_event
+    """
+
+    s3_event: Dict
+    message_identifiers: Dict[str, List[str]]
+    malformed_messages: List[str]
+
+
+def is_sqs_event(event) -> bool:
+    records = event.get("Records") if isinstance(event, dict) else None
+    return bool(records) and records[0].get("eventSource") == "aws:sqs"
+
+
+def get_s3_event_from_sqs_event(event: Dict) -> Tuple[Dict, Dict[str, List[str]], List[str]]:
+    """
+    Unwraps the S3 events delivered as the body of the messages in an SQS event. Returns a tuple with a single S3 event
+    containing the records of all messages, the identifiers referred to by each message by message ID,
+    and the IDs of the messages whose body is not an S3 event.
+    The test events sent by S3 when notifications are configured contain no records, so they are ignored.
+    """
+    records: List[Dict] = []
+    message_identifiers: Dict[str, List[str]] = {}
+    malformed_messages: List[str] = []
+    for message in event["Records"]:
+        try:
+            message_records = json.loads(message["body"]).get("Records", [])
+            message_identifiers[message["messageId"]] = [
+                get_identifier_from_s3_key(record["s3"]["bucket"]["name"], record["s3"]["object"]["key"])[0]
+                for record in message_records
+            ]
+        except (ValueError, KeyError, AttributeError) as e:
+            print(f"Ignoring SQS message {message['messageId']} that is not an S3 event: {e}")
+            malformed_messages.append(message["messageId"])
+            continue
+        records += message_records
+    return {"Records": records}, message_identifiers, malformed_messages
+
+
+def parse_domain(line: bytes) -> str:
+    """
+    Returns the domain in a line of a domains file, normalized to lower case without a trailing dot,
+    with internationalized domain names converted to their ASCII (punycode) form.
+    Returns an empty string for blank lines and comments (anything following a "#").
+    """
+    domain = line.decode("utf-8").split("#", 1)[0].strip().rstrip(".").lower()
+    if not domain.isascii():
+        domain = domain.encode("idna").decode("ascii")
+    return domain
+
+
+def read_domains_from_s3_file(bucket, key) -> Tuple[List[str], str]:
+    """
+    Return the list of unique domains in the s3 file, one per line, in the order they first appear,
+    together with the ETag of the object (without quotes, which are not allowed in ACM tags).
+    The file is read line by line as it is downloaded, see parse_domain for how each line is handled.
+    """
+    domains: Dict[str, None] = {}
+    s3_object = get_s3_client().get_object(Bucket=bucket, Key=key)
+    for line in s3_object["Body"].iter_lines():
+        domain = parse_domain(line)
+        if domain:
+            domains[domain] = None
+    return list(domains), s3_object["ETag"].strip('"')
+
+
 def get_domains_from_s3_file(bucket, key) -> List[str]:
     """
-    Return a list of lines of the s3 file
+    Return the list of unique domains in the s3 file, see read_domains_from_s3_file
+    """
+    return read_domains_from_s3_file(bucket, key)[0]
+
+
+def shard_domains(identifier: str, domains: List[str]) -> List[Tuple[str, List[str]]]:
+    """
+    Splits domains in groups of at most MAX_DOMAINS_PER_CERTIFICATE, returning a list of (identifier, domains) tuples.
+    If all domains fit in a single certificate, the identifier is kept as is.
+    Otherwise, the identifier of each group is suffixed with the group's position, like "identifier.0".
+    """
+    groups = [
+        domains[start : start + MAX_DOMAINS_PER_CERTIFICATE]
+        for start in range(0, len(domains), MAX_DOMAINS_PER_CERTIFICATE)
+    ]
+    return list(zip(shard_identifiers(identifier, len(groups)), groups))
+
+
+def shard_identifiers(identifier: str, shards: int) -> List[str]:
+    """
+    Returns the identifiers of the certificates of a file split into a number of shards, see shard_domains()
     """
-    return s3_client.get_object(Bucket=bucket, Key=key)["Body"].read().decode("ascii").strip("\n").split("\n")
+    if shards <= 1:
+        return [identifier]
+    return [f"{identifier}{SHARD_SEPARATOR}{shard}" for shard in range(shards)]
 
 
+def get_regional_actions() -> Dict[str, certifier.actions]:
+    """
+    Returns the actions of each region certificates are managed in by region, starting with the region of the lambda
+    """
+    return {
+        actions.region_name: actions,
+        **{
+            region: region_actions
+            for region, region_actions in regional_actions.items()
+            if region != actions.region_name
+        },
+    }
+
+
+def for_each_region(function: Callable[[certifier.actions], Any]) -> Dict[str, Any]:
+    """
+    Calls function with the actions of each region concurrently, returning the results by region.
+    If it raised an exception in any region, the first one is raised once all regions are done.
+    """
+    all_actions = get_regional_actions()
+    with ThreadPoolExecutor(max_workers=len(all_actions)) as executor:
+        futures = {region: executor.submit(function, region_actions) for region, region_actions in all_actions.items()}
+    results: Dict[str, Any] = {}
+    errors: List[Exception] = []
+    for region, future in futures.items():
+        try:
+            results[region] = future.result()
+        except Exception as e:
+            print(f"Failed in region {region} with the following reason: {e}")
+            errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def get_file_identifier(identifier: str) -> str:
+    """
+    Returns the identifier of the file a certificate identifier belongs to, without the position of its shard if any
+    """
+    shard_match = SHARD_PATTERN.fullmatch(identifier)
+    return shard_match.group(1) if shard_match else identifier
+
+
+def process_leased(
+    actions: certifier.actions,
+    certificates: List[certifier.Certificate],
+    process: Callable[[List[certifier.Certificate]], Any],
+) -> None:
+    """
+    Calls process() with the certificates whose file identifier could be leased, holding the leases until it returns.
+    Certificates of files leased by another invocation are skipped, to be processed by a later run.
+    """
+    with actions.lease({get_file_identifier(certificate.identifier) for certificate in certificates}) as leased:
+        skipped = [
+            certificate.arn for certificate in certificates if get_file_identifier(certificate.identifier) not in leased
+        ]
+        if skipped:
+            print(f"Skipping certificates of identifiers leased by another invocation: {skipped}")
+        process([certificate for certificate in certificates if get_file_identifier(certificate.identifier) in leased])
+
+
+def get_certificates_for_file(actions: certifier.actions, identifier: str) -> List[certifier.Certificate]:
+    """
+    Returns the certificates of an identifier together with the certificates of its shards
+    """
+    return [certificate for certificate in actions.query() if get_file_identifier(certificate.identifier) == identifier]
+
+
+def sweep(
+    actions: certifier.actions,
+    name: str,
+    state: certifier.States,
+    process: Callable[[List[certifier.Certificate]], None],
+    context,
+) -> Dict:
+    """
+    Scans the certificates in a state in the order of their ARN (see certifier.actions.scan) and calls process()
+    with batches of at least actions.max_workers certificates, until all certificates are processed or the lambda
+    is about to time out, in which case the last ARN scanned and processed is saved as a cursor.
+    The remaining time is checked before each chunk of the scan, so a run stops in time even when retrieving
+    the tags of all certificates would take longer than the lambda can run.
+    Certificates up to the cursor saved by the previous run are skipped, so consecutive runs make progress
+    through any number of certificates. The cursor is removed once a run reaches the last certificate.
+    Writes to Parameter Store queued by a batch are sent before the next one,
+    so that the time they take is accounted for before the next batch starts.
+    """
+    cursor = actions.get_sweep_cursor(name)
+    chunks = actions.scan(state, after=cursor)
+    batch: List[certifier.Certificate] = []
+    scanned_until, processed_until = cursor, cursor
+    processed = 0
+    while True:
+        if context is not None and context.get_remaining_time_in_millis() < SWEEP_TIME_MARGIN:
+            actions.set_sweep_cursor(name, processed_until)
+            print(f"Stopping {name} before timing out after {processed} certificates, saved cursor.")
+            return {"complete": False, "processed": processed}
+        chunk = next(chunks, None)
+        if chunk is not None:
+            certificates, scanned_until = chunk
+            batch.extend(certificates)
+        if batch and (chunk is None or len(batch) >= actions.max_workers):
+            process(batch)
+            actions.flush()
+            processed += len(batch)
+            batch = []
+        if not batch:
+            processed_until = scanned_until
+        if chunk is None:
+            break
+    if cursor is not None:
+        actions.set_sweep_cursor(name, None)
+    return {"complete": True, "processed": processed}
+
+
+@invocation
 def delete_certificates(event, context):
     """
-    Handler for lambda to delete certificates
+    Handler for lambda to delete certificates, returning the result of the sweep in each region by region
+    """
+
+    def delete_in_region(actions: certifier.actions) -> Dict:
+        def delete(certificates: List[certifier.Certificate]) -> None:
+            print(actions.delete(certificates))
+
+        return sweep(
+            actions,
+            "delete-certificates",
+            certifier.States.MARKED_FOR_DELETION,
+            functools.partial(process_leased, actions, process=delete),
+            context,
+        )
+
+    return for_each_region(delete_in_region)
+
+
+def apply_certificate_change(
+    actions: certifier.actions,
+    action: str,
+    certificate: Tuple[str, str, str],
+    domains_file: Optional[Future] = None,
+) -> None:
+    """
+    Marks the certificates of an identifier for deletion when action is "delete",
+    or requests a certificate with the domains from the S3 object when action is "create".
+    When the S3 object is already being read, domains_file is the future of read_domains_from_s3_file.
+    The identifier is leased while the change is applied, see certifier.actions.lease,
+    and LeaseUnavailable is raised if another invocation holds the lease for longer than LEASE_WAIT seconds.
     """
-    print(actions.delete(actions.query(state=certifier.States.MARKED_FOR_DELETION)))
+    bucket, key, identifier = certificate
+    # Leased under the same name as the certificates of the file in process_leased()
+    lease_name = get_file_identifier(identifier)
+    with actions.lease([lease_name], LEASE_WAIT) as leased:
+        if lease_name not in leased:
+            raise leases.LeaseUnavailable(f"{lease_name} is leased by another invocation")
+        _apply_certificate_change(actions, action, bucket, key, identifier, domains_file)
+
+
+def _apply_certificate_change(
+    actions: certifier.actions, action: str, bucket: str, key: str, identifier: str, domains_file: Optional[Future]
+) -> None:
+    if action == "delete":
+        actions.mark_for_deletion(get_certificates_for_file(actions, identifier))
+    if action == "create":
+        domains, etag = domains_file.result() if domains_file is not None else read_domains_from_s3_file(bucket, key)
+        if not domains:
+            raise ValueError(f"No domains found in s3://{bucket}/{key}")
+        shards = shard_domains(identifier, domains)
+        identifiers = [shard_identifier for shard_identifier, _ in shards]
+        # Certificates of shards that are no longer part of the file, or of the whole file if it is now sharded
+        previous_certificates = [
+            existing_certificate
+            for existing_certificate in get_certificates_for_file(actions, identifier)
+            if existing_certificate.identifier not in identifiers
+            and existing_certificate.state
+            in (certifier.States.PENDING, certifier.States.AVAILABLE, certifier.States.GAVE_UP)
+        ]
+        previous_available = [
+            certificate for certificate in previous_certificates if certificate.state == certifier.States.AVAILABLE
+        ]
+        metadata = {certifier.Tags.SOURCE_ETAG: etag}
+        if previous_available:
+            # Available certificates stay in use until every shard is available, see mark_previous_shards()
+            metadata[certifier.Tags.SHARDS] = str(len(shards))
+        requested = [
+            actions.request_certificate(shard_identifier, shard_domain_names, metadata=metadata)
+            for shard_identifier, shard_domain_names in shards
+        ]
+        if all(certificate.state == certifier.States.AVAILABLE for certificate in requested):
+            previous_available = []
+        actions.mark_for_deletion(
+            [certificate for certificate in previous_certificates if certificate not in previous_available]
+        )
 
 
+def mark_previous_shards(actions: certifier.actions, certificates: List[certifier.Certificate]) -> None:
+    """
+    Marks the available certificates of the files of the certificates for deletion when their identifier is no longer
+    one of the file's shards, once a certificate of each shard is available. The number of shards of a file is tagged
+    in Tags.SHARDS of the certificates requested while certificates of its previous shards were available.
+    """
+    for certificate in certificates:
+        if certifier.Tags.SHARDS not in certificate.metadata:
+            continue
+        file_identifier = get_file_identifier(certificate.identifier)
+        current_identifiers = shard_identifiers(file_identifier, int(certificate.metadata[certifier.Tags.SHARDS]))
+        available = [
+            file_certificate
+            for file_certificate in get_certificates_for_file(actions, file_identifier)
+            if file_certificate.state == certifier.States.AVAILABLE
+        ]
+        if set(current_identifiers) <= {file_certificate.identifier for file_certificate in available}:
+            actions.mark_for_deletion(
+                [
+                    file_certificate
+                    for file_certificate in available
+                    if file_certificate.identifier not in current_identifiers
+                ]
+            )
+
+
+def apply_certificate_changes(
+    changes: Dict[str, List[Tuple[str, Tuple[str, str, str]]]], result: Dict[str, List[Dict[str, str]]]
+):
+    """
+    Applies the changes of each region by region concurrently with apply_certificate_change,
+    reporting the result of each one in the result dict under "succeeded" or "failed".
+    Each S3 object is downloaded once, however many regions a certificate is requested in.
+    """
+    all_actions = get_regional_actions()
+    with ThreadPoolExecutor(max_workers=actions.max_workers) as executor:
+        # Submitted first, so they are never waited on before they start
+        domains_files: Dict[Tuple[str, str], Future] = {}
+        for region_changes in changes.values():
+            for action, (bucket, key, _) in region_changes:
+                if action == "create" and (bucket, key) not in domains_files:
+                    domains_files[(bucket, key)] = executor.submit(read_domains_from_s3_file, bucket, key)
+        futures = {
+            executor.submit(
+                apply_certificate_change, all_actions[region], action, certificate, domains_files.get(certificate[:2])
+            ): (region, action, certificate)
+            for region, region_changes in changes.items()
+            for action, certificate in region_changes
+        }
+        for change in as_completed(futures):
+            region, action, (bucket, key, identifier) = futures[change]
+            change_result = {"region": region, "action": action, "bucket": bucket, "key": key, "identifier": identifier}
+            try:
+                change.result()
+                result["succeeded"].append(change_result)
+            except Exception as e:
+                print(
+                    f"Failed to {action} certificate from s3://{bucket}/{key} in {region} with the following reason: {e}"
+                )
+                all_actions[region].metrics.increment("ChangesFailed")
+                result["failed"].append({**change_result, "reason": str(e)})
+
+
+@invocation
 def manage_certificates(event, context):
     """
-    Handler for lambda to manage certificates
+    Handler for lambda to manage certificates in every region.
+    Changes for different identifiers and regions are applied concurrently, the result of each one is reported
+    in the returned dict under "succeeded" or "failed".
+    S3 events can also be delivered through SQS, in which case the records of all messages are planned together,
+    and the messages referring to an identifier whose change failed are reported under "batchItemFailures"
+    so that only those are delivered again.
     """
+    message_identifiers = None
+    if isinstance(event, SQSBatch):
+        event, message_identifiers, malformed_messages = (
+            event.s3_event,
+            event.message_identifiers,
+            event.malformed_messages,
+        )
+
     (
         certificates_to_delete,
         certificates_to_create,
         certificates_failed,
-    ) = get_certificates_from_s3_event(event)
-    for certificate in certificates_to_delete:
-        actions.mark_for_deletion(actions.query(identifier=certificate[2]))
-    for certificate in certificates_to_create:
-        bucket, key, identifier = certificate
-        domains = get_domains_from_s3_file(bucket, key)
-        actions.request_certificate(identifier, domains)
+    ) = plan_certificates_from_s3_event(event)
+
+    result: Dict[str, List[Dict[str, str]]] = {"succeeded": [], "failed": []}
     for certificate in certificates_failed:
         print(
             f"Failed to create certificate from s3://{'/'.join(certificate[:2])} with the following reason: {certificate[2]}"
         )
+        result["failed"].append({"bucket": certificate[0], "key": certificate[1], "reason": certificate[2]})
+
+    changes = [("delete", certificate) for certificate in certificates_to_delete] + [
+        ("create", certificate) for certificate in certificates_to_create
+    ]
+    apply_certificate_changes({region: changes for region in get_regional_actions()}, result)
 
     print(f"Delete: {certificates_to_delete}, Create: {certificates_to_create}")
+    if message_identifiers is not None:
+        # Changes that failed a validation are left out, as they would fail again
+        failed_identifiers = {change["identifier"] for change in result["failed"] if "identifier" in change}
+        result["batchItemFailures"] = [{"itemIdentifier": message_id} for message_id in malformed_messages] + [
+            {"itemIdentifier": message_id}
+            for message_id, identifiers in message_identifiers.items()
+            if failed_identifiers.intersection(identifiers)
+        ]
+    return result
 
 
-def transition_certificates(event, context):
+def transition(actions: certifier.actions, certificates: List[certifier.Certificate]) -> None:
     """
-    Handler for lambda to transition certificates
+    Describes pending certificates, retrying the ones that failed validation
+    and transitioning the ones that were issued to the available state, all at once,
+    so that the certificate issued last wins when several certificates of an identifier were issued.
+    Certificates of identifiers leased by another invocation are skipped, see process_leased.
     """
-    certificates = actions.query(with_acm_state=True)
+    process_leased(actions, certificates, functools.partial(_transition, actions))
+
+
+def _transition(actions: certifier.actions, certificates: List[certifier.Certificate]) -> None:
+    actions.describe(certificates)
+    issued_certificates: List[certifier.Certificate] = []
     for certificate in certificates:
         if certificate.state == certifier.States.PENDING:
             if certificate.acm_state == "FAILED":
-                print(f"Failed to validate certificate, retrying: {certificate}")
-                actions.retry(certificate)
+                retried_certificate = actions.retry(certificate)
+                if retried_certificate is not None:
+                    print(f"Failed to validate certificate, retried as {retried_certificate.arn}: {certificate}")
             if certificate.acm_state == "ISSUED":
                 print(f"Transitioning certificate to available state: {certificate}")
-                actions.transition_to_available([certificate])
+                issued_certificates.append(certificate)
+    actions.transition_to_available(issued_certificates)
+    mark_previous_shards(actions, issued_certificates)
+
+
+@invocation
+def transition_certificates(event, context):
+    """
+    Handler for lambda to transition certificates, returning the result of the sweep in each region by region.
+    Pending certificates of an identifier scanned in the same batch are transitioned together, see transition().
+    """
+
+    def transition_in_region(actions: certifier.actions) -> Dict:
+        def transition_due(certificates: List[certifier.Certificate]) -> None:
+            # Certificates that failed validation and are not due for a retry are skipped without describing them
+            now = time.time()
+            transition(
+                actions,
+                [certificate for certificate in certificates if not actions.waiting_for_retry(certificate, now)],
+            )
+
+        return sweep(actions, "transition-certificates", certifier.States.PENDING, transition_due, context)
+
+    return for_each_region(transition_in_region)
+
+
+@invocation
+def transition_certificate_events(event, context):
+    """
+    Handler for lambda to transition the certificates referred to by ACM events from EventBridge.
+    Only the certificates in the event's resources are looked up, instead of all certificates,
+    using the actions of the region in their ARN.
+    """
+    all_actions = get_regional_actions()
+    for certificate_arn in event.get("resources", []):
+        region_actions = all_actions.get(certificate_arn.split(":")[3], actions)
+        certificate = region_actions.get_certificate(certificate_arn)
+        if certificate is None or certificate.state != certifier.States.PENDING:
+            print(f"Ignoring event for certificate not pending in certifier: {certificate_arn}")
+            continue
+        transition(region_actions, [certificate])
+
+
+def list_s3_files(bucket: str) -> Generator[Dict, None, None]:
+    """
+    Lists all objects in a bucket, as returned in the "Contents" of list_objects_v2 responses
+    """
+    for page in get_s3_client().get_paginator("list_objects_v2").paginate(Bucket=bucket):
+        yield from page.get("Contents", [])
+
+
+def get_domains_files(bucket: str) -> Tuple[Dict[str, List[Tuple[str, str]]], List[Tuple[str, str, str]]]:
+    """
+    Lists the objects in the bucket, returning a tuple with the (key, ETag) of the objects of each identifier
+    by identifier, and the objects that failed a validation, like get_certificates_from_s3_event.
+    Profiles under PROFILES_PREFIX are skipped.
+    """
+    files: Dict[str, List[Tuple[str, str]]] = {}
+    failed_certificates: List[Tuple[str, str, str]] = []
+    for s3_object in list_s3_files(bucket):
+        if s3_object["Key"].startswith(PROFILES_PREFIX):
+            continue
+        identifier, failed_reason = get_identifier_from_s3_key(bucket, s3_object["Key"])
+        if failed_reason:
+            failed_certificates.append((bucket, s3_object["Key"], failed_reason))
+            continue
+        files.setdefault(identifier, []).append((s3_object["Key"], s3_object["ETag"].strip('"')))
+    return files, failed_certificates
+
+
+def plan_backfill(
+    actions: certifier.actions,
+    identifier: str,
+    shard_certificates: Dict[str, List[certifier.Certificate]],
+    domains: List[str],
+    etag: str,
+) -> Optional[List[Tuple[certifier.Certificate, Dict[certifier.Tags, str]]]]:
+    """
+    Compares the domains of the file of an identifier with the domains of the current certificates of its shards,
+    by shard identifier, returning the tags to add to each certificate when they all match,
+    or None when a certificate must be requested.
+    Certificates without Tags.DOMAINS_HASH (e.g. requested before it was introduced) are described to get their domains.
+    """
+    shards = shard_domains(identifier, domains)
+    if {shard_identifier for shard_identifier, _ in shards} != set(shard_certificates):
+        return None
+    actions.describe(
+        [
+            certificate
+            for certificates in shard_certificates.values()
+            for certificate in certificates
+            if certifier.Tags.DOMAINS_HASH not in certificate.metadata
+        ]
+    )
+    backfill: List[Tuple[certifier.Certificate, Dict[certifier.Tags, str]]] = []
+    for shard_identifier, shard_domain_names in shards:
+        domains_hash = actions.domains_hash(shard_domain_names)
+        for certificate in shard_certificates[shard_identifier]:
+            certificate_hash = certificate.metadata.get(certifier.Tags.DOMAINS_HASH)
+            if (certificate_hash or actions.domains_hash(certificate.domains or [])) != domains_hash:
+                return None
+            backfill.append(
+                (certificate, {certifier.Tags.DOMAINS_HASH: domains_hash, certifier.Tags.SOURCE_ETAG: etag})
+            )
+    return backfill
+
+
+def plan_reconciliation(
+    actions: certifier.actions,
+    bucket: str,
+    files: Dict[str, List[Tuple[str, str]]],
+    read_domains: Callable[[str, str], Tuple[List[str], str]] = read_domains_from_s3_file,
+) -> Tuple[
+    List[Tuple[str, str, str]],
+    List[certifier.Certificate],
+    List[Tuple[certifier.Certificate, Dict[certifier.Tags, str]]],
+]:
+    """
+    Compares the files in the bucket, as returned by get_domains_files, with the pending and available certificates,
+    returning a tuple containing three lists: files for which a certificate must be requested, like in
+    get_certificates_from_s3_event, certificates that are no longer backed by a file and must be marked for deletion,
+    and certificates with the tags to add to them, see below.
+    A file is up to date when the current certificate of each of its shards (the pending one, or the available one
+    if there is no pending certificate) was requested from an object with the same ETag, so it is not downloaded again.
+    Certificates retries were given up on count as current, so their file is only requested again once it changes.
+    When current certificates have no Tags.SOURCE_ETAG, e.g. as they were requested before it was introduced,
+    the file is read with read_domains and its certificates are only tagged with its ETag and domains hash,
+    instead of being requested again, if they have the same domains (see plan_backfill).
+    """
+    # file identifier -> certificate identifier -> certificates
+    file_certificates: Dict[str, Dict[str, List[certifier.Certificate]]] = {}
+    delete_certificates: List[certifier.Certificate] = []
+    for certificate in actions.query():
+        if certificate.state not in (certifier.States.PENDING, certifier.States.AVAILABLE, certifier.States.GAVE_UP):
+            continue
+        file_identifier = get_file_identifier(certificate.identifier)
+        if file_identifier not in files:
+            delete_certificates.append(certificate)
+            continue
+        file_certificates.setdefault(file_identifier, {}).setdefault(certificate.identifier, []).append(certificate)
+
+    create_certificates: List[Tuple[str, str, str]] = []
+    backfill_certificates: List[Tuple[certifier.Certificate, Dict[certifier.Tags, str]]] = []
+    for identifier, objects in sorted(files.items()):
+        current_certificates = {
+            shard_identifier: (
+                [certificate for certificate in certificates if certificate.state != certifier.States.AVAILABLE]
+                or certificates
+            )
+            for shard_identifier, certificates in file_certificates.get(identifier, {}).items()
+        }
+        current_etags = {
+            certificate.metadata.get(certifier.Tags.SOURCE_ETAG)
+            for certificates in current_certificates.values()
+            for certificate in certificates
+        }
+        if len(current_etags) == 1 and any(etag in current_etags for _, etag in objects):
+            continue
+        key = sorted(objects)[0][0]
+        if None in current_etags:
+            try:
+                backfill = plan_backfill(actions, identifier, current_certificates, *read_domains(bucket, key))
+            except Exception as e:
+                print(f"Failed to compare s3://{bucket}/{key} with its certificates with the following reason: {e}")
+                backfill = None
+            if backfill is not None:
+                backfill_certificates.extend(backfill)
+                continue
+        create_certificates.append((bucket, key, identifier))
+
+    return create_certificates, delete_certificates, backfill_certificates
+
+
+@invocation
+def reconcile_certificates(event, context):
+    """
+    Handler for lambda to reconcile certificates in every region with the contents of the bucket, repairing changes
+    missed from S3 events. Certificates are requested for new and changed files and marked for deletion when their file
+    no longer exists, certificates without source tags are tagged when they match their file (see plan_reconciliation).
+    The bucket is listed once, the planned changes are reported by region.
+    When "dry_run" is set in the event (or CERTIFIER_RECONCILE_DRY_RUN in the environment),
+    the planned changes are only reported.
+    """
+    event = event or {}
+    bucket = event.get("bucket", CERTIFICATES_BUCKET)
+    dry_run = event.get("dry_run", RECONCILE_DRY_RUN)
+    files, certificates_failed = get_domains_files(bucket)
+    # Files compared with certificates without source tags are downloaded once for all regions
+    read_domains = functools.lru_cache(maxsize=None)(read_domains_from_s3_file)
+    plans = for_each_region(lambda actions: plan_reconciliation(actions, bucket, files, read_domains))
+
+    for region, (certificates_to_create, certificates_to_delete, certificates_to_backfill) in plans.items():
+        print(
+            f"{'Planned' if dry_run else 'Reconciling'} changes for s3://{bucket} in {region}: "
+            f"Create: {certificates_to_create}, Delete: {[certificate.arn for certificate in certificates_to_delete]}, "
+            f"Tag: {[certificate.arn for certificate, _ in certificates_to_backfill]}"
+        )
+    result: Dict = {
+        "dry_run": dry_run,
+        "create": {region: [identifier for _, _, identifier in plan[0]] for region, plan in plans.items()},
+        "delete": {region: [certificate.arn for certificate in plan[1]] for region, plan in plans.items()},
+        "backfill": {region: [certificate.arn for certificate, _ in plan[2]] for region, plan in plans.items()},
+        "succeeded": [],
+        "failed": [{"bucket": bucket, "key": key, "reason": reason} for _, key, reason in certificates_failed],
+    }
+    if dry_run:
+        return result
+
+    all_actions = get_regional_actions()
+    for region, (_, certificates_to_delete, certificates_to_backfill) in plans.items():
+        region_actions = all_actions[region]
+        process_leased(region_actions, certificates_to_delete, region_actions.mark_for_deletion)
+        backfill_metadata = {certificate.arn: metadata for certificate, metadata in certificates_to_backfill}
+        process_leased(
+            region_actions,
+            [certificate for certificate, _ in certificates_to_backfill],
+            lambda certificates: [
+                region_actions.update_metadata(certificate, backfill_metadata[certificate.arn])
+                for certificate in certificates
+            ],
+        )
+    apply_certificate_changes(
+        {
+            region: [("create", certificate) for certificate in certificates_to_create]
+            for region, (certificates_to_create, _, _) in plans.items()
+        },
+        result,
+    )
+    return result
+
+
+@invocation
+def export_validation_records(event, context):
+    """
+    Handler for lambda to export the validation records of all pending certificates in every region
+    as Route 53 ChangeBatch documents, by hosted zone ID. Records shared by several certificates are exported once.
+    When "apply" is set in the event (or CERTIFIER_APPLY_VALIDATION_RECORDS in the environment),
+    the records are upserted in Route 53.
+    """
+    event = event or {}
+    apply = event.get("apply", APPLY_VALIDATION_RECORDS)
+    exporter = validation.ValidationRecordExporter(actions.route53_client)
+    records = for_each_region(lambda actions: actions.validation_records())
+    batches, unmatched = exporter.change_batches(
+        record for region_records in records.values() for record in region_records
+    )
+    for name in unmatched:
+        print(f"No public hosted zone found for validation record {name}")
+    print(f"Validation record change batches: {json.dumps(batches)}")
+    result = {"apply": apply, "change_batches": batches, "unmatched": unmatched, "changes": []}
+    if apply:
+        result["changes"] = exporter.apply(batches)
+    return result
+
+
+@invocation
+def scan_certificates(event, context):
+    """
+    Handler for lambda to report the health of the available certificates in every region, by region.
+    All available certificates of a region are described in a single concurrent pass and classified
+    by days to expiry and managed renewal status, see certifier.actions.check_health.
+    When "renew" is set in the event (or CERTIFIER_RENEW_AT_RISK in the environment),
+    certificates at risk of expiring are requested again, to replace them once issued,
+    unless their identifier already has a pending certificate.
+    """
+    event = event or {}
+    renew = event.get("renew", RENEW_AT_RISK)
+
+    def scan_region(actions: certifier.actions) -> Dict:
+        certificates = actions.query(state=certifier.States.AVAILABLE)
+        report = actions.check_health(certificates, EXPIRY_WARNING_DAYS, EXPIRY_CRITICAL_DAYS)
+        at_risk = report.at_risk()
+        renewed: List[str] = []
+        if renew and at_risk:
+            process_leased(
+                actions,
+                [certificate for certificate in certificates if certificate.arn in at_risk],
+                lambda leased: renewed.extend(
+                    renewal.arn for renewal in map(actions.renew, leased) if renewal is not None
+                ),
+            )
+        return {**dataclasses.asdict(report), "at_risk": at_risk, "renewed": renewed}
+
+    reports = for_each_region(scan_region)
+    print(f"Certificate health: {json.dumps(reports)}")
+    return {"renew": renew, "regions": reports}
+
+
+@invocation
+def rebuild_state_store(event, context):
+    """
+    Handler for lambda to rebuild the state store of every region from the certifier tags in ACM,
+    e.g. after creating the table or if it was changed outside of certifier
+    """
+    removed = for_each_region(lambda actions: actions.rebuild_state_store())
+    print(f"Rebuilt state store, removed certificates that no longer exist: {removed}")
+    return {"removed": removed}
@@ -16,10 +16,23 @@
 
 
 import json
+import boto3  # type: ignore
+import moto  # type: ignore
+from moto import mock_dynamodb  # type: ignore
 import pytest
 import handlers
 
 
+@pytest.fixture(scope="function")
+def handler_clients(monkeypatch, s3_client, acm_client, ssm_client):
+    """
+    Replace the clients created when importing handlers with clients created within the moto mocks
+    """
+    actions = handlers.certifier.actions()
+    monkeypatch.setattr(handlers, "actions", actions)
+    monkeypatch.setattr(handlers, "s3_client", actions.install(s3_client))
+
+
 def test_get_certificates_from_s3_event():
     with pytest.test_files["s3_event_created.json"].open() as event_created_file, pytest.test_files[
         "s3_event_removed.json"
@@ -36,3 +49,408 @@ def test_get_certificates_from_s3_event():
 
 
 # def test_get_file_from_s3(s3_client):
+
+
+def test_plan_certificates_from_s3_event():
+    with pytest.test_files["s3_event_batch.json"].open() as event_batch_file:
+        event_batch = json.loads(event_batch_file.read())
+    delete, create, failed = handlers.plan_certificates_from_s3_event(event_batch)
+    assert delete == [("backups-marco", "brand/a.txt", "brand/a")]
+    assert create == [("backups-marco", "brand/b.txt", "brand/b"), ("backups-marco", "brand/c.csv", "brand/c")]
+    assert len(failed) == 1
+
+
+def test_manage_certificates(handler_clients, s3_client):
+    with pytest.test_files["s3_event_batch.json"].open() as event_batch_file:
+        event_batch = json.loads(event_batch_file.read())
+    s3_client.create_bucket(Bucket="backups-marco")
+    s3_client.put_object(Bucket="backups-marco", Key="brand/b.txt", Body=b"b.example.com\n")
+    result = handlers.manage_certificates(event_batch, None)
+    assert sorted(change["identifier"] for change in result["succeeded"]) == ["brand/a", "brand/b"]
+    assert sorted(change.get("identifier", change["key"]) for change in result["failed"]) == ["brand/c", "brand/d$.txt"]
+    assert len(handlers.actions.query(identifier="brand/b", state=handlers.certifier.States.PENDING)) == 1
+
+
+def test_get_domains_from_s3_file(handler_clients, s3_client):
+    s3_client.create_bucket(Bucket="certificates")
+    s3_client.put_object(
+        Bucket="certificates",
+        Key="domains.txt",
+        Body="# Main domains\r\nExample.com.\r\n\r\nwww.example.com # website\nexample.com\nbücher.example.com\n".encode(),
+    )
+    assert handlers.get_domains_from_s3_file("certificates", "domains.txt") == [
+        "example.com",
+        "www.example.com",
+        "xn--bcher-kva.example.com",
+    ]
+
+
+def test_shard_domains(monkeypatch):
+    monkeypatch.setattr(handlers, "MAX_DOMAINS_PER_CERTIFICATE", 2)
+    assert handlers.shard_domains("brand/a", ["1.com", "2.com"]) == [("brand/a", ["1.com", "2.com"])]
+    assert handlers.shard_domains("brand/a", ["1.com", "2.com", "3.com"]) == [
+        ("brand/a.0", ["1.com", "2.com"]),
+        ("brand/a.1", ["3.com"]),
+    ]
+
+
+def test_manage_certificates_sharded(handler_clients, s3_client, monkeypatch):
+    monkeypatch.setattr(handlers, "MAX_DOMAINS_PER_CERTIFICATE", 2)
+    with pytest.test_files["s3_event_created.json"].open() as event_created_file:
+        event_created = json.loads(event_created_file.read())
+    s3_client.create_bucket(Bucket="backups-marco")
+    s3_client.put_object(Bucket="backups-marco", Key="battery.txt", Body=b"1.example.com\n2.example.com\n")
+    handlers.manage_certificates(event_created, None)
+    s3_client.put_object(Bucket="backups-marco", Key="battery.txt", Body=b"1.example.com\n2.example.com\n3.example.com")
+    handlers.manage_certificates(event_created, None)
+    pending = handlers.actions.query(state=handlers.certifier.States.PENDING)
+    assert sorted(certificate.identifier for certificate in pending) == ["battery.0", "battery.1"]
+    assert len(handlers.actions.query(identifier="battery", state=handlers.certifier.States.MARKED_FOR_DELETION)) == 1
+
+
+def test_sharded_file_replaces_available_certificate(handler_clients, s3_client, monkeypatch):
+    monkeypatch.setattr(handlers, "MAX_DOMAINS_PER_CERTIFICATE", 2)
+    monkeypatch.setattr(moto.settings, "ACM_VALIDATION_WAIT", 0)
+    s3_client.create_bucket(Bucket="backups-marco")
+    s3_client.put_object(Bucket="backups-marco", Key="battery.txt", Body=b"1.example.com\n2.example.com\n")
+    handlers.apply_certificate_change(handlers.actions, "create", ("backups-marco", "battery.txt", "battery"))
+    available = handlers.actions.query(identifier="battery")[0]
+    handlers.actions.transition_to_available([available])
+
+    s3_client.put_object(Bucket="backups-marco", Key="battery.txt", Body=b"1.example.com\n2.example.com\n3.example.com")
+    handlers.apply_certificate_change(handlers.actions, "create", ("backups-marco", "battery.txt", "battery"))
+    shards = sorted(handlers.actions.query(state=handlers.certifier.States.PENDING), key=lambda c: c.identifier)
+    assert [shard.metadata[handlers.certifier.Tags.SHARDS] for shard in shards] == ["2", "2"]
+    # The certificate of the whole file stays available until the certificates of all its shards are
+    handlers.transition(handlers.actions, shards[:1])
+    assert handlers.actions.query(identifier="battery")[0].state == handlers.certifier.States.AVAILABLE
+    handlers.transition(handlers.actions, shards[1:])
+    assert handlers.actions.query(identifier="battery")[0].state == handlers.certifier.States.MARKED_FOR_DELETION
+    assert {
+        certificate.identifier for certificate in handlers.actions.query(state=handlers.certifier.States.AVAILABLE)
+    } == {
+        "battery.0",
+        "battery.1",
+    }
+
+
+def test_shards_of_other_files(handler_clients, s3_client, monkeypatch):
+    monkeypatch.setattr(handlers, "MAX_DOMAINS_PER_CERTIFICATE", 2)
+    s3_client.create_bucket(Bucket="backups-marco")
+    s3_client.put_object(Bucket="backups-marco", Key="brand/0.txt", Body=b"0.example.com\n")
+    s3_client.put_object(Bucket="backups-marco", Key="brand.txt", Body=b"1.example.com\n2.example.com\n3.example.com\n")
+    handlers.apply_certificate_change(handlers.actions, "create", ("backups-marco", "brand/0.txt", "brand/0"))
+    handlers.apply_certificate_change(handlers.actions, "create", ("backups-marco", "brand.txt", "brand"))
+    handlers.apply_certificate_change(handlers.actions, "delete", ("backups-marco", "brand.txt", "brand"))
+    assert len(handlers.actions.query(identifier="brand/0", state=handlers.certifier.States.PENDING)) == 1
+    assert sorted(
+        certificate.identifier for certificate in handlers.get_certificates_for_file(handlers.actions, "brand")
+    ) == [
+        "brand.0",
+        "brand.1",
+    ]
+
+
+def test_manage_certificates_unchanged_file(handler_clients, s3_client):
+    with pytest.test_files["s3_event_created.json"].open() as event_created_file:
+        event_created = json.loads(event_created_file.read())
+    s3_client.create_bucket(Bucket="backups-marco")
+    s3_client.put_object(Bucket="backups-marco", Key="battery.txt", Body=b"1.example.com\n2.example.com\n")
+    handlers.manage_certificates(event_created, None)
+    s3_client.put_object(Bucket="backups-marco", Key="battery.txt", Body=b"2.example.com\n1.example.com\n")
+    handlers.manage_certificates(event_created, None)
+    assert len(handlers.actions.query(identifier="battery")) == 1
+
+
+def test_reconcile_certificates(handler_clients, s3_client, monkeypatch):
+    with pytest.test_files["s3_event_created.json"].open() as event_created_file:
+        event_created = json.loads(event_created_file.read())
+    s3_client.create_bucket(Bucket="backups-marco")
+    s3_client.put_object(Bucket="backups-marco", Key="battery.txt", Body=b"1.example.com\n")
+    handlers.manage_certificates(event_created, None)
+    s3_client.put_object(Bucket="backups-marco", Key="brand/new.txt", Body=b"new.example.com\n")
+    s3_client.put_object(Bucket="backups-marco", Key="invalid$.txt", Body=b"invalid.example.com\n")
+    stale_certificate = handlers.actions.request_certificate("brand/gone", ["gone.example.com"])
+    downloaded = []
+    read_domains_from_s3_file = handlers.read_domains_from_s3_file
+    monkeypatch.setattr(
+        handlers,
+        "read_domains_from_s3_file",
+        lambda bucket, key: downloaded.append(key) or read_domains_from_s3_file(bucket, key),
+    )
+
+    plan = handlers.reconcile_certificates({"bucket": "backups-marco", "dry_run": True}, None)
+    assert (plan["create"], plan["delete"]) == ({"us-east-1": ["brand/new"]}, {"us-east-1": [stale_certificate.arn]})
+    assert [failure["key"] for failure in plan["failed"]] == ["invalid$.txt"]
+    assert handlers.actions.query(identifier="brand/new") == [] and downloaded == []
+
+    result = handlers.reconcile_certificates({"bucket": "backups-marco"}, None)
+    assert [change["identifier"] for change in result["succeeded"]] == ["brand/new"]
+    assert downloaded == ["brand/new.txt"]
+    assert handlers.actions.query(identifier="brand/gone")[0].state == handlers.certifier.States.MARKED_FOR_DELETION
+    plan = handlers.reconcile_certificates({"bucket": "backups-marco", "dry_run": True}, None)
+    assert (plan["create"], plan["delete"]) == ({"us-east-1": []}, {"us-east-1": []})
+
+
+def test_reconcile_legacy_certificates(handler_clients, s3_client, acm_client):
+    s3_client.create_bucket(Bucket="backups-marco")
+    s3_client.put_object(Bucket="backups-marco", Key="legacy.txt", Body=b"legacy.example.com\nwww.legacy.example.com\n")
+    s3_client.put_object(Bucket="backups-marco", Key="changed.txt", Body=b"new.example.com\n")
+    legacy_arns = {}
+    for identifier, domains in (
+        ("legacy", ["www.legacy.example.com", "legacy.example.com"]),
+        ("changed", ["old.example.com"]),
+    ):
+        arn = acm_client.request_certificate(
+            DomainName=domains[0], SubjectAlternativeNames=domains[1:] or domains, ValidationMethod="DNS"
+        )["CertificateArn"]
+        acm_client.add_tags_to_certificate(
+            CertificateArn=arn,
+            Tags=[
+                {"Key": "certifier_id", "Value": identifier},
+                {"Key": "certifier_state", "Value": "certifier_available"},
+            ],
+        )
+        legacy_arns[identifier] = arn
+
+    result = handlers.reconcile_certificates({"bucket": "backups-marco"}, None)
+    assert result["create"] == {"us-east-1": ["changed"]}
+    assert result["backfill"] == {"us-east-1": [legacy_arns["legacy"]]}
+    assert handlers.actions.query(identifier="legacy", state=handlers.certifier.States.PENDING) == []
+    tags = {
+        tag["Key"]: tag["Value"]
+        for tag in acm_client.list_tags_for_certificate(CertificateArn=legacy_arns["legacy"])["Tags"]
+    }
+    assert tags["certifier_domains_hash"] == handlers.actions.domains_hash(
+        ["legacy.example.com", "www.legacy.example.com"]
+    )
+    assert "certifier_source_etag" in tags
+
+    plan = handlers.reconcile_certificates({"bucket": "backups-marco", "dry_run": True}, None)
+    assert (plan["create"], plan["backfill"]) == ({"us-east-1": []}, {"us-east-1": []})
+
+
+def test_manage_certificates_from_sqs(handler_clients, s3_client, sqs_client):
+    queue_url = sqs_client.create_queue(QueueName="certifier")["QueueUrl"]
+    for event_file in ("s3_event_created.json", "s3_event_batch.json"):
+        sqs_client.send_message(QueueUrl=queue_url, MessageBody=pytest.test_files[event_file].read_text())
+    sqs_client.send_message(QueueUrl=queue_url, MessageBody=json.dumps({"Event": "s3:TestEvent"}))
+    sqs_client.send_message(QueueUrl=queue_url, MessageBody="not json")
+    messages = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)["Messages"]
+    event = {
+        "Records": [
+            {"messageId": message["MessageId"], "body": message["Body"], "eventSource": "aws:sqs"}
+            for message in messages
+        ]
+    }
+    s3_client.create_bucket(Bucket="backups-marco")
+    s3_client.put_object(Bucket="backups-marco", Key="battery.txt", Body=b"example.com\n")
+    s3_client.put_object(Bucket="backups-marco", Key="brand/b.txt", Body=b"b.example.com\n")
+
+    result = handlers.manage_certificates(event, None)
+    # brand/c.csv does not exist, and the last message is not an S3 event
+    assert result["batchItemFailures"] == [
+        {"itemIdentifier": messages[3]["MessageId"]},
+        {"itemIdentifier": messages[1]["MessageId"]},
+    ]
+    assert sorted(change["identifier"] for change in result["succeeded"]) == ["battery", "brand/a", "brand/b"]
+
+
+def test_manage_certificates_in_regions(handler_clients, s3_client, monkeypatch):
+    regional_actions = handlers.certifier.actions(region="eu-central-1")
+    monkeypatch.setattr(handlers, "regional_actions", {"eu-central-1": regional_actions})
+    with pytest.test_files["s3_event_created.json"].open() as event_created_file:
+        event_created = json.loads(event_created_file.read())
+    s3_client.create_bucket(Bucket="backups-marco")
+    s3_client.put_object(Bucket="backups-marco", Key="battery.txt", Body=b"example.com\n")
+    downloaded = []
+    read_domains_from_s3_file = handlers.read_domains_from_s3_file
+    monkeypatch.setattr(
+        handlers,
+        "read_domains_from_s3_file",
+        lambda bucket, key: downloaded.append(key) or read_domains_from_s3_file(bucket, key),
+    )
+
+    result = handlers.manage_certificates(event_created, None)
+    assert sorted(change["region"] for change in result["succeeded"]) == ["eu-central-1", "us-east-1"]
+    assert downloaded == ["battery.txt"]
+    for actions in (handlers.actions, regional_actions):
+        certificates = actions.query(identifier="battery")
+        assert len(certificates) == 1 and certificates[0].arn.split(":")[3] == actions.region_name
+    assert handlers.delete_certificates({}, None) == {
+        "us-east-1": {"complete": True, "processed": 0},
+        "eu-central-1": {"complete": True, "processed": 0},
+    }
+
+
+def test_transition_certificate_events(handler_clients, acm_client, ssm_client, monkeypatch):
+    actions = handlers.actions
+    actions.request_certificate("brand/a", ["a.example.com"])
+    previous = actions.query(identifier="brand/a")[0]
+    actions.transition_to_available([previous])
+    actions.request_certificate("brand/a", ["a.example.com", "www.a.example.com"])
+    pending = actions.query(identifier="brand/a", state=handlers.certifier.States.PENDING)[0]
+    monkeypatch.setattr(moto.settings, "ACM_VALIDATION_WAIT", 0)
+
+    with pytest.test_files["acm_event_certificate_available.json"].open() as event_file:
+        event = json.loads(event_file.read())
+    event["resources"] = [pending.arn]
+    list_certificates_requests = actions.rate_limiter.stats["ListCertificates"]["requests"]
+    handlers.transition_certificate_events(event, None)
+
+    assert actions.rate_limiter.stats["ListCertificates"]["requests"] == list_certificates_requests
+    assert ssm_client.get_parameter(Name="/certifier/brand/a")["Parameter"]["Value"] == pending.arn
+    actions.reset_inventory()
+    assert actions.query(identifier="brand/a", state=handlers.certifier.States.AVAILABLE)[0].arn == pending.arn
+    assert (
+        actions.query(identifier="brand/a", state=handlers.certifier.States.MARKED_FOR_DELETION)[0].arn == previous.arn
+    )
+
+
+def test_manage_certificates_leased_identifier(handler_clients, s3_client, acm_client, monkeypatch):
+    with mock_dynamodb():
+        handlers.leases.DynamoDBLeases(boto3.client("dynamodb"), "certifier-leases").create_table()
+        actions = handlers.certifier.actions(lease_table="certifier-leases")
+        monkeypatch.setattr(handlers, "actions", actions)
+        monkeypatch.setattr(handlers, "LEASE_WAIT", 0)
+        with pytest.test_files["s3_event_created.json"].open() as event_created_file:
+            event_created = json.loads(event_created_file.read())
+        s3_client.create_bucket(Bucket="backups-marco")
+        s3_client.put_object(Bucket="backups-marco", Key="battery.txt", Body=b"example.com\n")
+
+        other_invocation = handlers.certifier.actions(lease_table="certifier-leases")
+        with other_invocation.lease(["battery"]):
+            result = handlers.manage_certificates(event_created, None)
+        assert result["succeeded"] == [] and result["failed"][0]["identifier"] == "battery"
+        result = handlers.manage_certificates(event_created, None)
+        assert [change["identifier"] for change in result["succeeded"]] == ["battery"]
+
+        monkeypatch.setattr(moto.settings, "ACM_VALIDATION_WAIT", 0)
+        with other_invocation.lease(["battery"]):
+            handlers.transition_certificates({}, None)
+        assert actions.query(identifier="battery")[0].state == handlers.certifier.States.PENDING
+        handlers.transition_certificates({}, None)
+        assert actions.query(identifier="battery")[0].state == handlers.certifier.States.AVAILABLE
+
+        # A file named after a number is leased under its own identifier by every handler
+        s3_client.put_object(Bucket="backups-marco", Key="brand/1.txt", Body=b"example.com\n")
+        with other_invocation.lease(["brand/1"]):
+            with pytest.raises(handlers.leases.LeaseUnavailable):
+                handlers.apply_certificate_change(actions, "create", ("backups-marco", "brand/1.txt", "brand/1"))
+        handlers.apply_certificate_change(actions, "create", ("backups-marco", "brand/1.txt", "brand/1"))
+        with other_invocation.lease(["brand/1"]):
+            handlers.transition_certificates({}, None)
+        assert actions.query(identifier="brand/1")[0].state == handlers.certifier.States.PENDING
+
+
+def test_scan_certificates(handler_clients, monkeypatch):
+    certificate = handlers.actions.request_certificate("brand/a", ["a.example.com"])
+    handlers.actions.transition_to_available([certificate])
+    result = handlers.scan_certificates({"renew": True}, None)
+    assert result["regions"]["us-east-1"]["healthy"] == [certificate.arn]
+    assert result["regions"]["us-east-1"]["renewed"] == []
+
+    monkeypatch.setattr(handlers, "EXPIRY_WARNING_DAYS", 100000)
+    monkeypatch.setattr(handlers, "EXPIRY_CRITICAL_DAYS", 100000)
+    result = handlers.scan_certificates({"renew": True}, None)
+    assert result["regions"]["us-east-1"]["critical"] == [certificate.arn]
+    renewed = result["regions"]["us-east-1"]["renewed"]
+    assert len(renewed) == 1
+    assert handlers.actions.query(identifier="brand/a", state=handlers.certifier.States.PENDING)[0].arn == renewed[0]
+
+
+def test_invocation_profile(handler_clients, s3_client, monkeypatch, capsys):
+    s3_client.create_bucket(Bucket="backups-marco")
+    monkeypatch.setattr(handlers, "CERTIFICATES_BUCKET", "backups-marco")
+    monkeypatch.setattr(handlers, "PROFILE", True)
+    handlers.transition_certificates({}, None)
+    keys = sorted(s3_object["Key"] for s3_object in handlers.list_s3_files("backups-marco"))
+    assert len(keys) == 2 and all(key.startswith("_profiles/transition_certificates/") for key in keys)
+    assert keys[0].endswith(".prof") and keys[1].endswith(".txt")
+
+    with pytest.test_files["s3_event_created.json"].open() as event_created_file:
+        event_created = json.loads(event_created_file.read())
+    event_created["Records"][0]["s3"]["object"]["key"] = keys[0]
+    assert handlers.get_certificates_from_s3_event(event_created) == ([], [], [])
+    assert handlers.get_domains_files("backups-marco") == ({}, [])
+
+    # Events for profiles only are not profiled, otherwise every upload would trigger two more
+    handlers.manage_certificates(event_created, None)
+    sqs_event = {
+        "Records": [
+            {"eventSource": "aws:sqs", "messageId": "profile", "body": json.dumps(event_created)},
+        ]
+    }
+    handlers.manage_certificates(sqs_event, None)
+    assert len(list(handlers.list_s3_files("backups-marco"))) == 2
+
+    # SQS messages are only parsed once, so malformed ones are only logged once
+    capsys.readouterr()
+    sqs_event["Records"].append({"eventSource": "aws:sqs", "messageId": "malformed", "body": "not json"})
+    assert handlers.manage_certificates(sqs_event, None)["batchItemFailures"] == [{"itemIdentifier": "malformed"}]
+    assert capsys.readouterr().out.count("Ignoring SQS message malformed") == 1
+
+
+class Context:
+    """
+    Lambda context running out of time after a number of calls to get_remaining_time_in_millis
+    """
+
+    def __init__(self, calls_left):
+        self.calls_left = calls_left
+
+    def get_remaining_time_in_millis(self):
+        self.calls_left -= 1
+        return 60000 if self.calls_left >= 0 else 0
+
+
+def test_sweep_resumes_from_cursor(handler_clients, monkeypatch):
+    monkeypatch.setattr(handlers.actions, "max_workers", 2)
+    for number in range(5):
+        handlers.actions.request_certificate(f"brand/{number}", [f"{number}.example.com"])
+    certificates = sorted(handlers.actions.query(state=handlers.certifier.States.PENDING), key=lambda c: c.arn)
+    handlers.actions.reset_inventory()
+    handlers.actions.metrics.reset()
+    processed = []
+    result = handlers.sweep(handlers.actions, "test", handlers.certifier.States.PENDING, processed.extend, Context(2))
+    assert result == {"complete": False, "processed": 4}
+    assert handlers.actions.get_sweep_cursor("test") == certificates[3].arn
+    # The run stopped in the middle of the scan, without retrieving the tags of the remaining certificate
+    assert handlers.actions.metrics.counters["acm.ListTagsForCertificate.Calls"] == 4
+    result = handlers.sweep(handlers.actions, "test", handlers.certifier.States.PENDING, processed.extend, Context(2))
+    assert result == {"complete": True, "processed": 1}
+    assert handlers.actions.get_sweep_cursor("test") is None
+    assert processed == certificates
+
+
+def test_sweep_flushes_each_batch(handler_clients, ssm_client, monkeypatch):
+    monkeypatch.setattr(handlers.actions, "max_workers", 1)
+    for identifier in ("brand/a", "brand/b"):
+        handlers.actions.request_certificate(identifier, [f"{identifier[-1]}.example.com"])
+    certificates = sorted(handlers.actions.query(state=handlers.certifier.States.PENDING), key=lambda c: c.arn)
+    result = handlers.sweep(
+        handlers.actions,
+        "test",
+        handlers.certifier.States.PENDING,
+        handlers.actions.transition_to_available,
+        Context(1),
+    )
+    assert result["complete"] is False
+    # The parameter of the transitioned certificate is written even though the invocation ran out of time
+    parameter_name = handlers.actions.parameters.name(certificates[0].identifier)
+    assert ssm_client.get_parameter(Name=parameter_name)["Parameter"]["Value"] == certificates[0].arn
+
+
+def test_invocation_metrics(handler_clients, s3_client, capsys):
+    with pytest.test_files["s3_event_created.json"].open() as event_created_file:
+        event_created = json.loads(event_created_file.read())
+    s3_client.create_bucket(Bucket="backups-marco")
+    s3_client.put_object(Bucket="backups-marco", Key="battery.txt", Body=b"example.com\n")
+    handlers.manage_certificates(event_created, None)
+    metric_lines = [line for line in capsys.readouterr().out.split("\n") if line.startswith('{"_aws"')]
+    assert len(metric_lines) == 1
+    document = json.loads(metric_lines[0])
+    assert document["Function"] == "manage_certificates"
+    assert document["CertificatesRequested"] == 1
+    assert document["s3.GetObject.Calls"] == 1
+    assert len(document["Duration"]) == 1